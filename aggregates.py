@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Out-of-core aggregation of the cleaned transactions.
+
+For histories too large to load, ``python aggregates.py cleaned_df.csv``
+computes everything the dashboard draws in one map-reduce pass: a pool of
+worker processes parses and aggregates blocks of the CSV, and their partial
+aggregates are merged as they arrive. The result is saved next to the CSV
+(``cleaned_df.aggregates.pkl``), and the app started with
+DATA_MODE=aggregates loads it instead of the rows. Cross-filter selections
+are answered by another pass with the selection applied.
+
+Every partial is additive (sums, counts, value counts and the first row of
+each group), so merging partials gives the same numbers as aggregating all
+the rows at once. Memory is bounded by ``memory_limit``: blocks are sized so
+that the blocks being parsed, plus the ones queued for the workers, fit in
+it.
+"""
+
+import io
+import os
+import sys
+import pickle
+import argparse
+import threading
+import multiprocessing
+import tempfile
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+import pandas as pd
+
+import datastore
+
+
+# The home page panels; every table but these and the state rollup is
+# filtered by the whole selection.
+DIMENSIONS = ['Ship Mode', 'Segment', 'Region', 'Category']
+STATE_KEYS = ['State', 'state_code', 'Region']
+DISCOUNT_KEYS = ['Category', 'Sub-Category', 'Discount']
+BOX_KEYS = ['Discount', 'Gross PM']
+SUNBURST_KEYS = ['Category', 'Sub-Category']
+KPI_COLUMNS = ['Transactions', 'Sales', 'Profit', 'Quantity', 'Losses']
+# (label, upper bound) of the discount bands the KPIs are broken down by,
+# each band above the previous one's bound
+DISCOUNT_BANDS = [('No discount', 0), ('Up to 20%', 0.2), ('20% to 40%', 0.4), ('Over 40%', 1)]
+
+# Saved aggregates of another format are rebuilt
+FORMAT = 2
+
+# Parsing a block takes about this many times its size in memory
+BLOCK_OVERHEAD = 8
+# Smaller blocks would spend more on their per-block work than they save
+MIN_BLOCK_BYTES = 2**20
+
+
+def without(selection, dim):
+    return {k: v for k, v in selection.items() if k != dim}
+
+
+def where(rows, selection):
+    if not selection:
+        return rows
+    mask = np.ones(len(rows), dtype=bool)
+    for col, value in selection.items():
+        mask &= (rows[col] == value).to_numpy()
+    return rows[mask]
+
+
+def _factorize(column):
+    """Integer codes of a key column (-1 for missing) and the values they
+    stand for. Categorical columns already hold theirs."""
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        return column.cat.codes.to_numpy(), column.cat.categories
+    return pd.factorize(column, sort=True)
+
+
+def group_sums(rows, keys, columns):
+    """``rows.groupby(keys, as_index=False, observed=True)`` summing each of
+    ``columns``, with the group sizes as Transactions.
+
+    The key columns are factorized once into integer codes, which combine
+    into a single group code per row; every column is then summed with
+    np.bincount over it. Groups come out in the order pandas sorts them,
+    with categorical keys keeping their categories. Rows with a missing key
+    are left out, as pandas does; the summed columns must have no missing
+    values.
+    """
+    keys = [keys] if isinstance(keys, str) else list(keys)
+    codes, uniques = zip(*(_factorize(rows[key]) for key in keys))
+    codes = [c.astype(np.intp) for c in codes]
+    shape = tuple(len(values) for values in uniques)
+    valid = np.logical_and.reduce([c >= 0 for c in codes])
+    complete = valid.all()
+    flat = np.ravel_multi_index([c if complete else c[valid] for c in codes], shape)
+
+    cells = int(np.prod(shape))
+    dense = cells <= max(len(flat), 2**16)
+    if dense:
+        # few enough key combinations to count into an array of them all
+        counts = np.bincount(flat, minlength=cells)
+        groups = np.flatnonzero(counts)
+        counts = counts[groups]
+    else:
+        groups, flat, counts = np.unique(flat, return_inverse=True, return_counts=True)
+
+    result = {}
+    for key, key_codes, values in zip(keys, np.unravel_index(groups, shape), uniques):
+        if isinstance(rows[key].dtype, pd.CategoricalDtype):
+            result[key] = pd.Categorical.from_codes(key_codes, dtype=rows[key].dtype)
+        else:
+            result[key] = np.asarray(values)[key_codes]
+    for col in columns:
+        values = rows[col].to_numpy()
+        sums = np.bincount(flat, weights=values if complete else values[valid],
+                           minlength=cells if dense else len(groups))
+        sums = sums[groups] if dense else sums
+        # integer sums are int64, whatever the width of the column
+        result[col] = sums.astype(np.int64) if values.dtype.kind in 'iu' else sums
+    result['Transactions'] = counts.astype(np.int64)
+    return pd.DataFrame(result)
+
+
+def grouped_sums(rows, keys):
+    """group_by, with Discount summed instead of averaged so it merges."""
+    return group_sums(rows, keys, ['Sales', 'Profit', 'Quantity', 'Discount'])
+
+
+def discount_sums(rows):
+    return group_sums(rows, DISCOUNT_KEYS, ['Sales', 'Profit', 'Quantity'])
+
+
+def box_counts(rows):
+    """How many rows have each (Discount, Gross PM) pair: enough for exact
+    box plot statistics, since Gross PM is rounded to cents."""
+    counts = rows.groupby(BOX_KEYS, observed=True).size()
+    return counts.reset_index(name='count')
+
+
+def sunburst_sums(rows):
+    # first: the row each leaf first appears on, which is the order Plotly
+    # Express lays the leaves out in
+    return rows.assign(PQ=rows['Profit'] * rows['Quantity'],
+                       first=rows.index).groupby(SUNBURST_KEYS, as_index=False, observed=True, sort=False).agg(
+        Quantity=('Quantity','sum'), PQ=('PQ','sum'), first=('first','min'))
+
+
+def sunburst_leaves(sums):
+    """One row per sub-category, as Plotly Express aggregates the rows for
+    the sunburst: Quantity summed, Profit averaged weighted by Quantity."""
+    leaves = sums.sort_values('first', ignore_index=True)
+    leaves['Profit'] = leaves['PQ'] / leaves['Quantity']
+    return leaves[SUNBURST_KEYS + ['Quantity', 'Profit']]
+
+
+def kpi_sums(rows):
+    """The KPI sums of ``rows`` per discount level, in one pass over the
+    numeric columns: transactions, Sales, Profit and Quantity, and how many
+    transactions made a loss."""
+    levels, codes = np.unique(rows['Discount'].to_numpy(), return_inverse=True)
+    profit = rows['Profit'].to_numpy()
+    columns = [None, rows['Sales'].to_numpy(), profit, rows['Quantity'].to_numpy(), profit < 0]
+    sums = {col: np.bincount(codes, weights=w, minlength=len(levels)) for col, w in zip(KPI_COLUMNS, columns)}
+    return pd.DataFrame(dict(Discount=levels, **sums))
+
+
+def kpis(sums):
+    """The headline KPIs from kpi_sums() tables: counts, sums, means per
+    transaction, the gross profit margin and the share of loss-making
+    transactions, overall and by discount band."""
+    def figures(table):
+        total = table[KPI_COLUMNS].sum()
+        n = total['Transactions']
+        return {'Transactions': int(n), 'Sales': float(total['Sales']), 'Profit': float(total['Profit']),
+                'Quantity': int(total['Quantity']),
+                'Average Sales': float(total['Sales'] / n) if n else float('nan'),
+                'Average Profit': float(total['Profit'] / n) if n else float('nan'),
+                'Average Discount': float((table['Discount'] * table['Transactions']).sum() / n) if n else float('nan'),
+                'Gross PM': float(total['Profit'] / total['Sales'] * 100) if total['Sales'] else float('nan'),
+                'Loss Share': float(total['Losses'] / n) if n else float('nan')}
+
+    band = np.searchsorted([bound for _, bound in DISCOUNT_BANDS], sums['Discount'].to_numpy())
+    result = figures(sums)
+    result['Bands'] = [dict(figures(sums[band == i]), Band=label)
+                       for i, (label, _) in enumerate(DISCOUNT_BANDS) if (band == i).any()]
+    return result
+
+
+def partial(rows, selection=None):
+    """Mergeable aggregates of ``rows``. The home page tables ignore their
+    own dimension of ``selection``; the KPIs ignore all of it."""
+    selection = selection or {}
+    part = {dim: grouped_sums(where(rows, without(selection, dim)), [dim]) for dim in DIMENSIONS}
+    part['State'] = grouped_sums(where(rows, without(selection, 'State')), STATE_KEYS)
+    selected = where(rows, selection)
+    part['discount'] = discount_sums(selected)
+    part['box'] = box_counts(selected)
+    part['sunburst'] = sunburst_sums(selected)
+    part['kpi'] = kpi_sums(rows)
+    return part
+
+
+def table_keys(name):
+    return {'State': STATE_KEYS, 'discount': DISCOUNT_KEYS, 'box': BOX_KEYS,
+            'sunburst': SUNBURST_KEYS, 'kpi': ['Discount']}.get(name, [name])
+
+
+def merge(parts):
+    """The partials in ``parts`` combined into one."""
+    merged = {}
+    for name in parts[0]:
+        both = pd.concat([part[name] for part in parts], ignore_index=True)
+        keys = table_keys(name)
+        how = {col: 'min' if col == 'first' else 'sum' for col in both.columns if col not in keys}
+        merged[name] = both.groupby(keys, as_index=False, observed=True, sort=False).agg(how)
+    return merged
+
+
+def _categorize(frame, keys):
+    # sorted categoricals, like the columns the in-memory path groups on
+    return frame.assign(**{key: pd.Categorical(frame[key].astype(str)) for key in keys if key != 'Discount'})
+
+
+def finalize(part):
+    """The tables the dashboard draws from a merged partial: the aggregate
+    cube (group_by and state_ results), the page-1 discount sums, the box
+    plot value counts, the sunburst leaves and the KPI sums."""
+    def means(frame, keys):
+        frame = _categorize(frame, keys).sort_values(keys, ignore_index=True)
+        frame['Discount'] = frame['Discount'] / frame['Transactions']
+        frame['Gross PM']=np.multiply(np.divide(frame['Profit'],frame['Sales']),100).round(2)
+        return frame
+
+    cube = {dim: means(part[dim], [dim])[[dim, 'Sales', 'Profit', 'Quantity', 'Discount', 'Transactions', 'Gross PM']]
+            for dim in DIMENSIONS}
+    states = means(part['State'], STATE_KEYS)[STATE_KEYS + ['Sales', 'Profit', 'Discount', 'Quantity', 'Transactions', 'Gross PM']]
+    cube['State'] = states.sort_values('Sales', ascending=False, ignore_index=True)
+    return {'cube': cube,
+            'discount': _categorize(part['discount'], DISCOUNT_KEYS).sort_values(DISCOUNT_KEYS, ignore_index=True),
+            'box': part['box'].sort_values(BOX_KEYS, ignore_index=True),
+            'sunburst': sunburst_leaves(_categorize(part['sunburst'], SUNBURST_KEYS)),
+            'kpi': part['kpi'].sort_values('Discount', ignore_index=True)}
+
+
+def read_block(header, block):
+    categories = {col: dtype for col, dtype in datastore.SCHEMA.items() if dtype == 'category'}
+    rows = pd.read_csv(io.BytesIO(header + block), dtype=categories)
+    return datastore.derive(datastore.apply_schema(rows))
+
+
+def map_block(header, block, selection):
+    rows = read_block(header, block)
+    return partial(rows, selection), len(rows)
+
+
+def blocks(f, block_bytes):
+    while True:
+        lines = f.readlines(block_bytes)
+        if not lines:
+            return
+        yield b''.join(lines)
+
+
+def pool_context():
+    """Where the processes of a pool started now come from. They are forked
+    while this process has a single thread, which is fast and imports
+    nothing again. A process forked from a threaded one could inherit a
+    lock another thread held, so those get a fork server instead, and it
+    imports the main module again in every process; see start_pool()."""
+    methods = multiprocessing.get_all_start_methods()
+    if 'fork' in methods and threading.active_count() == 1:
+        return multiprocessing.get_context('fork')
+    if 'forkserver' not in methods:
+        return multiprocessing.get_context('spawn')
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload([__name__])
+    return context
+
+
+# (pid, pool) of the pool start_pool() started for run() in this process
+_pool = None
+
+
+def start_pool(jobs=None):
+    """Start a pool for every later run() in this process. Call it while the
+    process has a single thread, as a server worker before its threads
+    start: the pool's processes are all forked there and then, and the
+    passes the requests make fork nothing."""
+    global _pool
+    pool = ProcessPoolExecutor(max_workers=jobs or os.cpu_count(), mp_context=pool_context())
+    # a fork pool starts all its processes with the first task
+    pool.submit(int).result()
+    _pool = (os.getpid(), pool)
+
+
+def run(csv_path, selection=None, jobs=None, memory_limit=2**30):
+    """Aggregate ``csv_path`` out of core and return finalize()'s tables."""
+    global _pool
+    jobs = jobs or os.cpu_count()
+    # jobs blocks being parsed, and as many queued behind them
+    block_bytes = max(memory_limit // (2 * jobs * BLOCK_OVERHEAD), MIN_BLOCK_BYTES)
+    parts = []
+    offset = 0
+    started = _pool[1] if _pool is not None and _pool[0] == os.getpid() else None
+    executor = nullcontext(started) if started else ProcessPoolExecutor(max_workers=jobs, mp_context=pool_context())
+    try:
+        with executor as pool, open(csv_path, 'rb') as f:
+            header = f.readline()
+
+            def collect(future):
+                nonlocal offset, parts
+                part, n = future.result()
+                part['sunburst']['first'] += offset
+                offset += n
+                parts.append(part)
+                # merge every few blocks, so the partials held stay bounded
+                if len(parts) >= 8:
+                    parts = [merge(parts)]
+
+            pending = deque()
+            for block in blocks(f, block_bytes):
+                pending.append(pool.submit(map_block, header, block, selection))
+                if len(pending) >= jobs:
+                    collect(pending.popleft())
+            while pending:
+                collect(pending.popleft())
+    except BrokenProcessPool:
+        if started:
+            # a process died; later passes start pools of their own
+            _pool = None
+        raise
+    if not parts:
+        parts = [partial(read_block(header, b''), selection)]
+    return finalize(merge(parts))
+
+
+def summary_path(csv_path):
+    return os.path.splitext(csv_path)[0] + '.aggregates.pkl'
+
+
+def build(csv_path, out=None, jobs=None, memory_limit=2**30):
+    """Aggregate ``csv_path`` and save the result; returns its path."""
+    out = out or summary_path(csv_path)
+    summary = run(csv_path, jobs=jobs, memory_limit=memory_limit)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(out)), suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        pickle.dump({'format': FORMAT, 'source': datastore.source_signature(csv_path), 'summary': summary}, f)
+    os.replace(tmp, out)
+    return out
+
+
+def load(csv_path, jobs=None, memory_limit=2**30):
+    """The saved aggregates of ``csv_path``, rebuilt first when stale."""
+    path = summary_path(csv_path)
+    try:
+        with open(path, 'rb') as f:
+            saved = pickle.load(f)
+        if saved.get('format') == FORMAT and saved['source'] == datastore.source_signature(csv_path):
+            return saved['summary']
+    except (OSError, EOFError, pickle.UnpicklingError):
+        pass
+    build(csv_path, path, jobs, memory_limit)
+    with open(path, 'rb') as f:
+        return pickle.load(f)['summary']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('csv', nargs='?', default='cleaned_df.csv')
+    parser.add_argument('-o', '--out', help='output file (default: <csv>.aggregates.pkl)')
+    parser.add_argument('-j', '--jobs', type=int, help='worker processes (default: one per CPU)')
+    parser.add_argument('--memory-limit', type=float, default=1024,
+                        help='MiB the blocks in flight may take (default: 1024)')
+    args = parser.parse_args(argv)
+    print(build(args.csv, args.out, args.jobs, int(args.memory_limit * 2**20)))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,50 @@
+// Clientside callbacks. Dash loads every script in assets/ automatically.
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    home: {
+        // Draws the home-page subplot grid and state bar for the selected
+        // tab from the aggregate tables and figure skeletons preloaded into
+        // the 'home-aggregates' store, so switching tabs never hits the server.
+        render: function(option, store) {
+            // Mirrors fill() in sidebar.py: each skeleton trace updated from
+            // the matching dict, nested dicts merged one level deep.
+            function fill(skeleton, traces) {
+                var fig = JSON.parse(JSON.stringify(skeleton));
+                fig.data.forEach(function(trace, i) {
+                    Object.keys(traces[i]).forEach(function(key) {
+                        var value = traces[i][key];
+                        trace[key] = (value && value.constructor === Object) ?
+                            Object.assign({}, trace[key], value) : value;
+                    });
+                });
+                if (store.template) {
+                    fig.layout.template = store.template;
+                }
+                return fig;
+            }
+
+            // Estimates carry the half-widths of their 95% confidence
+            // intervals, shown on hover as ESTIMATE_HOVER in sidebar.py.
+            function hover(arrays, skeleton, table, metric) {
+                if (table.ci) {
+                    arrays.customdata = table.ci[metric];
+                    arrays.hovertemplate = (skeleton.hovertemplate || '%{x}: %{y}').replace(
+                        '%{y}', '%{y:,.3~f} ± %{customdata:,.3~f}');
+                }
+                return arrays;
+            }
+
+            var subplot = fill(store.subplot, store.panels.map(function(panel, i) {
+                return hover({x: panel.x, y: panel[option]}, store.subplot.data[i], panel, option);
+            }));
+
+            var metric = option === 'Transactions' ? 'Sales' : option;
+            var states = store.states;
+            var bar = fill(store.bar[metric], [hover(
+                {x: states.x, y: states[metric], marker: {color: states['Gross PM']}},
+                store.bar[metric].data[0], states, metric)
+            ]);
+            return [subplot, bar];
+        }
+    }
+});
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Benchmark the dashboard's data paths and callbacks on synthetic data.
+
+``python bench.py`` generates Superstore-shaped transactions at each size
+(10k to 10M rows by default) under ``bench-data/``, then runs each size in
+a fresh process. The process times the import of sidebar.py, group_by and
+state_ on the whole frame, aggregates.group_sums next to the pandas groupby
+it replaced, the routed page responses, and the page-1 and home page
+callbacks for every input combination. Results go to
+``bench-<commit>.json``: latency percentiles in milliseconds, response
+sizes in bytes, the peak RSS of the process and, for the page routes and
+callbacks, the most any one request raised the RSS above where it started
+(Linux only). ``python bench.py --compare old.json new.json`` prints the
+change in median latency and in that per-request peak between two runs.
+"""
+
+import os
+import sys
+import json
+import time
+import inspect
+import argparse
+import platform
+import resource
+import subprocess
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+
+SIZES = [10000, 100000, 1000000, 10000000]
+GROUP_KEYS = [['Ship Mode'], ['Discount', 'Category'], ['State', 'state_code', 'Region']]
+SELECTIONS = [{'State': 'California'}, {'Region': 'West', 'Category': 'Technology'},
+              {'Segment': 'Corporate', 'Ship Mode': 'Same Day', 'Sub-Category': 'Chairs'}]
+
+
+def generate(rows, path, source='cleaned_df.csv', seed=0, chunk=10**6):
+    """Write ``rows`` transactions drawn from ``source`` to ``path``.
+
+    Whole rows are resampled, so every column keeps its values and their
+    combinations (cities stay in their states, sub-categories in their
+    categories). Sales and Profit are scaled together by random factors,
+    which keeps each row's margin, so the numbers are not repeats of the
+    sample.
+    """
+    base = pd.read_csv(source)
+    rng = np.random.default_rng(seed)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        for start in range(0, rows, chunk):
+            n = min(chunk, rows - start)
+            sample = base.iloc[rng.integers(0, len(base), n)].reset_index(drop=True)
+            scale = rng.lognormal(0, 0.25, n)
+            sample['Sales'] = (sample['Sales'] * scale).round(2).clip(lower=0.01)
+            sample['Profit'] = (sample['Profit'] * scale).round(2)
+            sample['Prof_Cat'] = np.where(sample['Profit'] < 0, 'Loss', 'Profit')
+            sample.to_csv(f, index=False, header=start == 0)
+    os.replace(tmp, path)
+
+
+def stats(samples, size=None, memory=None):
+    ms = np.array(samples) * 1000
+    result = {'mean': ms.mean(), 'min': ms.min(), 'max': ms.max(),
+              'p50': np.percentile(ms, 50), 'p90': np.percentile(ms, 90), 'p99': np.percentile(ms, 99)}
+    result = dict({k: round(float(v), 3) for k, v in result.items()}, n=len(ms))
+    if size is not None:
+        result['bytes'] = size
+    if memory:
+        result['peak_rss_mb'] = round(float(max(memory)), 2)
+    return result
+
+
+def timed(func, repeat, memory=None):
+    """``repeat`` timings of ``func()`` and its last result. Given a list as
+    ``memory``, each call's peak RSS above the RSS it started from (MB) is
+    appended to it, where Linux lets the peak be reset."""
+    samples = []
+    for _ in range(repeat):
+        if memory is not None:
+            before = reset_peak_rss()
+        start = time.perf_counter()
+        result = func()
+        samples.append(time.perf_counter() - start)
+        if memory is not None and before is not None:
+            memory.append(proc_status_mb('VmHWM') - before)
+    return samples, result
+
+
+def peak_rss_mb():
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def proc_status_mb(field):
+    """A memory field of /proc/self/status (VmRSS, VmHWM, ...) in MB, or
+    None off Linux."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_rss():
+    """Reset this process's peak RSS to its current RSS, and return that
+    (MB); None where the kernel doesn't allow it."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        return None
+    return proc_status_mb('VmRSS')
+
+
+def run_size(data_file, repeat):
+    """Benchmark one dataset in this process; returns its results."""
+    os.environ['DATA_FILE'] = data_file
+    os.environ['CACHE_DIR'] = tempfile.mkdtemp(prefix='bench-cache-')
+    start = time.perf_counter()
+    import sidebar
+    import aggregates
+    result = {'rows': None, 'import_s': round(time.perf_counter() - start, 3),
+              'import_peak_rss_mb': peak_rss_mb(), 'benchmarks': {}}
+    bench = result['benchmarks']
+    encoder = sidebar.plotly.utils.PlotlyJSONEncoder
+    size_of = lambda value: len(json.dumps(value, cls=encoder).encode())
+
+    if sidebar.df is not None:
+        result['rows'] = len(sidebar.df)
+        for dim in sidebar.DIMENSIONS:
+            samples, _ = timed(lambda: sidebar.group_by(sidebar.df, dim), repeat)
+            bench['group_by[{}]'.format(dim)] = stats(samples)
+        samples, _ = timed(lambda: sidebar.state_(sidebar.df), repeat)
+        bench['state_'] = stats(samples)
+        # the grouping kernel against the pandas groupby it replaced
+        for keys in GROUP_KEYS:
+            label = ','.join(keys)
+            columns = [col for col in ['Sales', 'Profit', 'Quantity', 'Discount'] if col not in keys]
+            samples, _ = timed(lambda: aggregates.group_sums(sidebar.df, keys, columns), repeat)
+            bench['group_sums[{}]'.format(label)] = stats(samples)
+            groupby = lambda: sidebar.df.groupby(keys, as_index=False, observed=True).agg(
+                **{col: (col, 'sum') for col in columns}, Transactions=(columns[0], 'size'))
+            samples, _ = timed(groupby, repeat)
+            bench['pandas groupby[{}]'.format(label)] = stats(samples)
+
+    # Routed pages as the browser requests them. The first request builds
+    # and serializes the page, later ones are served from the cached bytes.
+    client = sidebar.server.test_client()
+    for pathname in sidebar.PAGES:
+        body = {'output': 'page-content.children',
+                'outputs': {'id': 'page-content', 'property': 'children'},
+                'inputs': [{'id': 'url', 'property': 'pathname', 'value': pathname}],
+                'changedPropIds': ['url.pathname']}
+        post = lambda: client.post('/_dash-update-component', json=body,
+                                   headers={'Accept-Encoding': 'identity'})
+        memory = []
+        samples, response = timed(post, 1, memory)
+        bench['render_page_content[{}] first'.format(pathname)] = stats(samples, len(response.data), memory)
+        memory = []
+        samples, response = timed(post, repeat, memory)
+        bench['render_page_content[{}]'.format(pathname)] = stats(samples, len(response.data), memory)
+
+    # Callbacks without their result cache, for every input combination,
+    # with the peak RSS each call adds to what the process held before it
+    update_output = inspect.unwrap(sidebar.update_output)
+    filtered_home = inspect.unwrap(sidebar.filtered_home)
+    filtered_profit_figures = inspect.unwrap(sidebar.filtered_profit_figures)
+    products = [None] + sorted(sidebar.discount_tensor['Sub-Category'][0])
+    for selection in [{}] + SELECTIONS:
+        label = 'all' if not selection else ','.join('{}={}'.format(k, v) for k, v in selection.items())
+        samples, sizes, memory = [], [], []
+        for tab in ['Profit', 'Quantity']:
+            for product in products:
+                part, figure = timed(lambda: update_output(tab, product, selection), repeat, memory)
+                samples += part
+                sizes.append(size_of(figure))
+        bench['update_output[{}]'.format(label)] = stats(samples, int(np.mean(sizes)), memory)
+        memory = []
+        samples, figures = timed(lambda: filtered_home(selection), repeat, memory)
+        bench['filtered_home[{}]'.format(label)] = stats(samples, size_of(figures), memory)
+        if selection:
+            memory = []
+            samples, figures = timed(lambda: filtered_profit_figures(selection), repeat, memory)
+            bench['filtered_profit_figures[{}]'.format(label)] = stats(samples, size_of(figures), memory)
+
+    result['peak_rss_mb'] = peak_rss_mb()
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print('{:>10}  {:<60} {:>10} {:>10} {:>8}'.format('rows', 'benchmark (p50 ms)', 'old', 'new', 'change'))
+    for size, results in new['sizes'].items():
+        before = old['sizes'].get(size)
+        if before is None:
+            continue
+        rows = [('import (s)', before['import_s'], results['import_s']),
+                ('peak RSS (MB)', before['peak_rss_mb'], results['peak_rss_mb'])]
+        rows += [(name, before['benchmarks'][name]['p50'], bench['p50'])
+                 for name, bench in results['benchmarks'].items() if name in before['benchmarks']]
+        rows += [(name + ' peak RSS (MB)', before['benchmarks'][name]['peak_rss_mb'], bench['peak_rss_mb'])
+                 for name, bench in results['benchmarks'].items()
+                 if 'peak_rss_mb' in bench and 'peak_rss_mb' in before['benchmarks'].get(name, {})]
+        for name, a, b in rows:
+            change = '{:+.0%}'.format(b / a - 1) if a else ''
+            print('{:>10}  {:<60} {:>10} {:>10} {:>8}'.format(size, name, a, b, change))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--repeat', type=int, default=10, help='timings per benchmark and input (default: 10)')
+    parser.add_argument('--data-dir', default='bench-data')
+    parser.add_argument('-o', '--out', help='results file (default: bench-<commit>.json)')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two results files')
+    parser.add_argument('--run', metavar='CSV', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        return compare(*args.compare)
+    if args.run:
+        json.dump(run_size(args.run, args.repeat), sys.stdout)
+        return
+
+    import datastore
+    commit = git_commit()
+    results = {'commit': commit,
+               'date': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'cpus': os.cpu_count(),
+               'versions': {name: __import__(name).__version__ for name in ['pandas', 'numpy', 'plotly', 'dash']},
+               'repeat': args.repeat,
+               'sizes': {}}
+    os.makedirs(args.data_dir, exist_ok=True)
+    for size in args.sizes:
+        data_file = os.path.join(args.data_dir, 'superstore_{}.csv'.format(size))
+        if not os.path.exists(data_file):
+            print('generating', data_file, file=sys.stderr)
+            generate(size, data_file)
+        # as gunicorn.conf.py does before the app is imported
+        if not datastore.is_fresh(data_file):
+            datastore.build(data_file)
+        print('benchmarking {} rows'.format(size), file=sys.stderr)
+        # a fresh process per size, for its import time and peak memory
+        run = subprocess.run([sys.executable, __file__, '--run', data_file, '--repeat', str(args.repeat)],
+                             capture_output=True, text=True, check=True)
+        results['sizes'][str(size)] = json.loads(run.stdout)
+
+    out = args.out or 'bench-{}.json'.format(commit)
+    with open(out, 'w') as f:
+        json.dump(results, f, indent=1)
+    print(out)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
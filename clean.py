@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Clean the raw Superstore export into the dashboard's transactions.
+
+``python clean.py SampleSuperstore.csv -o cleaned_df.csv`` reproduces
+cleaned_df.csv byte for byte: Country and Postal Code are dropped, Sales and
+Profit are rounded to cents, repeated rows are removed (keeping the first),
+and every row gets its state's postal code and whether it made a profit or
+a loss.
+
+The export is streamed in blocks of lines that worker processes clean in
+parallel, so memory is bounded by the block size and the number of workers
+rather than by the size of the file. Duplicates are found across the whole
+file without holding it: each cleaned row is hashed, and the hashes are
+spilled to disk in partitions that are deduplicated one at a time. Fields
+may be quoted but must not contain line breaks.
+"""
+
+import io
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import aggregates
+
+
+DROP = ['Country', 'Postal Code']
+NUMERIC = {'Sales': 'float64', 'Quantity': 'int64', 'Discount': 'float64', 'Profit': 'float64'}
+# cleaned_df.csv was written with Windows line endings
+LINE_TERMINATOR = '\r\n'
+
+# USPS codes. District of Columbia is 'dc' in cleaned_df.csv.
+STATE_CODES = {
+    'Alabama': 'AL', 'Alaska': 'AK', 'Arizona': 'AZ', 'Arkansas': 'AR',
+    'California': 'CA', 'Colorado': 'CO', 'Connecticut': 'CT', 'Delaware': 'DE',
+    'District of Columbia': 'dc', 'Florida': 'FL', 'Georgia': 'GA', 'Hawaii': 'HI',
+    'Idaho': 'ID', 'Illinois': 'IL', 'Indiana': 'IN', 'Iowa': 'IA',
+    'Kansas': 'KS', 'Kentucky': 'KY', 'Louisiana': 'LA', 'Maine': 'ME',
+    'Maryland': 'MD', 'Massachusetts': 'MA', 'Michigan': 'MI', 'Minnesota': 'MN',
+    'Mississippi': 'MS', 'Missouri': 'MO', 'Montana': 'MT', 'Nebraska': 'NE',
+    'Nevada': 'NV', 'New Hampshire': 'NH', 'New Jersey': 'NJ', 'New Mexico': 'NM',
+    'New York': 'NY', 'North Carolina': 'NC', 'North Dakota': 'ND', 'Ohio': 'OH',
+    'Oklahoma': 'OK', 'Oregon': 'OR', 'Pennsylvania': 'PA', 'Rhode Island': 'RI',
+    'South Carolina': 'SC', 'South Dakota': 'SD', 'Tennessee': 'TN', 'Texas': 'TX',
+    'Utah': 'UT', 'Vermont': 'VT', 'Virginia': 'VA', 'Washington': 'WA',
+    'West Virginia': 'WV', 'Wisconsin': 'WI', 'Wyoming': 'WY',
+}
+
+# (first hash, second hash, row number) of a cleaned row. Two independent
+# 64-bit hashes make a false duplicate practically impossible.
+HASH_RECORD = np.dtype([('h1', '<u8'), ('h2', '<u8'), ('row', '<i8')])
+SECOND_HASH_KEY = 'cleaned_df rows!'
+
+
+def clean(raw):
+    """The cleaned rows of a chunk of the export, duplicates included."""
+    df = raw.drop(columns=DROP)
+    df['Sales'] = df['Sales'].round(2)
+    df['Profit'] = df['Profit'].round(2)
+    df['state_code'] = df['State'].map(STATE_CODES)
+    unknown = df.loc[df['state_code'].isna(), 'State'].unique()
+    if len(unknown):
+        raise ValueError('no state code for: {}'.format(', '.join(unknown)))
+    df['Prof_Cat'] = np.where(df['Profit'] < 0, 'Loss', 'Profit')
+    return df
+
+
+def clean_block(header, block, path):
+    """Clean a block of raw lines into ``path`` (CSV without a header) and
+    return its columns and the hashes of its rows."""
+    columns = pd.read_csv(io.BytesIO(header), nrows=0).columns
+    dtypes = {col: NUMERIC.get(col, str) for col in columns}
+    df = clean(pd.read_csv(io.BytesIO(header + block), dtype=dtypes, keep_default_na=False))
+    df.to_csv(path, index=False, header=False, lineterminator=LINE_TERMINATOR)
+    return (list(df.columns),
+            pd.util.hash_pandas_object(df, index=False).to_numpy(),
+            pd.util.hash_pandas_object(df, index=False, hash_key=SECOND_HASH_KEY).to_numpy())
+
+
+def duplicate_rows(path):
+    """Row numbers in a partition of hashes that repeat an earlier row."""
+    records = np.fromfile(path, dtype=HASH_RECORD)
+    records = records[np.lexsort((records['row'], records['h2'], records['h1']))]
+    repeat = (records['h1'][1:] == records['h1'][:-1]) & (records['h2'][1:] == records['h2'][:-1])
+    return records['row'][1:][repeat]
+
+
+def run(source, out, jobs=None, block_bytes=16 * 2**20, partitions=64, tmp=None):
+    """Clean ``source`` into ``out`` and return the number of rows written."""
+    jobs = jobs or os.cpu_count()
+    with tempfile.TemporaryDirectory(dir=tmp) as work, \
+         ProcessPoolExecutor(max_workers=jobs) as pool, \
+         open(source, 'rb') as f:
+        header = f.readline()
+        spills = [os.path.join(work, 'hashes-{}.bin'.format(i)) for i in range(partitions)]
+        parts = []  # (path, first row, rows)
+        columns = None
+        rows = 0
+
+        def collect(path, future):
+            nonlocal columns, rows
+            columns, h1, h2 = future.result()
+            records = np.empty(len(h1), dtype=HASH_RECORD)
+            records['h1'], records['h2'] = h1, h2
+            records['row'] = np.arange(rows, rows + len(h1))
+            bucket = h1 % partitions
+            order = np.argsort(bucket, kind='stable')
+            bounds = np.searchsorted(bucket[order], np.arange(partitions + 1))
+            for i in range(partitions):
+                if bounds[i] < bounds[i+1]:
+                    with open(spills[i], 'ab') as spill:
+                        records[order[bounds[i]:bounds[i+1]]].tofile(spill)
+            parts.append((path, rows, len(h1)))
+            rows += len(h1)
+
+        # A few blocks in flight per worker: enough to keep them busy
+        # without reading ahead of them
+        pending = deque()
+        for i, block in enumerate(aggregates.blocks(f, block_bytes)):
+            path = os.path.join(work, 'part-{}.csv'.format(i))
+            pending.append((path, pool.submit(clean_block, header, block, path)))
+            if len(pending) >= 2 * jobs:
+                collect(*pending.popleft())
+        while pending:
+            collect(*pending.popleft())
+
+        if columns is None:
+            columns = clean(pd.read_csv(io.BytesIO(header), dtype=str)).columns
+        existing = [path for path in spills if os.path.exists(path)]
+        duplicates = np.sort(np.concatenate([np.empty(0, dtype=np.int64)] +
+                                            list(pool.map(duplicate_rows, existing))))
+
+        fd, tmp_out = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(out)), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as dest:
+            dest.write(pd.DataFrame(columns=columns).to_csv(index=False, lineterminator=LINE_TERMINATOR).encode())
+            for path, first, n in parts:
+                lo, hi = np.searchsorted(duplicates, [first, first + n])
+                with open(path, 'rb') as part:
+                    if lo == hi:
+                        shutil.copyfileobj(part, dest)
+                        continue
+                    lines = part.read().split(LINE_TERMINATOR.encode())[:-1]
+                drop = set((duplicates[lo:hi] - first).tolist())
+                dest.write(b''.join(line + LINE_TERMINATOR.encode()
+                                    for j, line in enumerate(lines) if j not in drop))
+        os.replace(tmp_out, out)
+    return rows - len(duplicates)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('source', nargs='?', default='SampleSuperstore.csv')
+    parser.add_argument('-o', '--out', default='cleaned_df.csv', help='output file (default: cleaned_df.csv)')
+    parser.add_argument('-j', '--jobs', type=int, help='worker processes (default: one per CPU)')
+    parser.add_argument('--block-size', type=float, default=16,
+                        help='MiB of raw lines cleaned per task (default: 16)')
+    parser.add_argument('--partitions', type=int, default=64,
+                        help='files the row hashes are spilled to (default: 64)')
+    parser.add_argument('--tmp', help='directory for intermediate files (default: system temp)')
+    args = parser.parse_args(argv)
+    rows = run(args.source, args.out, args.jobs, int(args.block_size * 2**20), args.partitions, args.tmp)
+    print('{}: {} rows'.format(args.out, rows))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Columnar binary store for the cleaned transactions.
+
+``python datastore.py cleaned_df.csv`` converts the CSV into a directory
+``cleaned_df.store/`` holding one ``.npy`` file per column, with the derived
+``Gross PM`` column already computed and every text column dictionary
+encoded as small integer codes following SCHEMA. ``load`` reads that
+directory back with memory-mapped arrays and falls back to parsing the CSV
+when the store is missing or was built from a different version of the file.
+"""
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+
+# Column -> dtype of the cleaned transactions. Text columns are categoricals
+# so groupbys hash small integer codes instead of strings. Quantity fits in
+# int16. Discount stays float64: its values are group keys and axis labels,
+# and float32 would turn 0.2 into 0.200000003.
+SCHEMA = {
+    'Ship Mode': 'category',
+    'Segment': 'category',
+    'City': 'category',
+    'State': 'category',
+    'Region': 'category',
+    'Category': 'category',
+    'Sub-Category': 'category',
+    'Sales': 'float64',
+    'Quantity': 'int16',
+    'Discount': 'float64',
+    'Profit': 'float64',
+    'state_code': 'category',
+    'Prof_Cat': 'category',
+}
+
+
+# Stores of another format are rebuilt
+FORMAT = 2
+
+
+def apply_schema(df):
+    """Cast ``df`` to SCHEMA, raising ValueError if it doesn't conform."""
+    missing = [col for col in SCHEMA if col not in df.columns]
+    if missing:
+        raise ValueError('missing columns: {}'.format(', '.join(missing)))
+    for col, dtype in SCHEMA.items():
+        if dtype == 'category':
+            if not isinstance(df[col].dtype, pd.CategoricalDtype):
+                df[col] = df[col].astype('category')
+            continue
+        if np.issubdtype(np.dtype(dtype), np.integer):
+            info = np.iinfo(dtype)
+            if len(df) and (df[col].min() < info.min or df[col].max() > info.max):
+                raise ValueError('{} does not fit in {}'.format(col, dtype))
+        if df[col].isna().any():
+            raise ValueError('{} has missing values'.format(col))
+        df[col] = df[col].astype(dtype)
+    return df
+
+
+def read_csv(csv_path):
+    categories = {col: dtype for col, dtype in SCHEMA.items() if dtype == 'category'}
+    return apply_schema(pd.read_csv(csv_path, dtype=categories))
+
+
+def derive(df):
+    """Add the columns the dashboard computes on top of the cleaned data."""
+    df['Gross PM']=np.multiply(np.divide(df['Profit'],df['Sales']),100).round(2)
+    return df
+
+
+def store_path(csv_path):
+    return os.path.splitext(csv_path)[0] + '.store'
+
+
+def source_signature(csv_path):
+    st = os.stat(csv_path)
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+
+def _code_dtype(n):
+    for dtype in (np.int8, np.int16, np.int32):
+        if n <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+
+def build(csv_path, out=None):
+    """Convert ``csv_path`` into a columnar store and return its path.
+
+    Processes may have the store's columns memory-mapped while it is rebuilt,
+    so the new columns are written to files of their own. Replacing meta.json
+    switches loaders to them at once, then the old files are unlinked; their
+    pages stay valid for as long as anything maps them.
+    """
+    out = out or store_path(csv_path)
+    df = derive(read_csv(csv_path))
+    os.makedirs(out, exist_ok=True)
+    build_id = os.urandom(4).hex()
+
+    columns = []
+    for i, name in enumerate(df.columns):
+        col = df[name]
+        categories = None
+        if isinstance(col.dtype, pd.CategoricalDtype):
+            categories = [str(x) for x in col.cat.categories]
+            values = col.cat.codes.to_numpy().astype(_code_dtype(len(categories)))
+        else:
+            values = col.to_numpy()
+        filename = '{}.{}.npy'.format(i, build_id)
+        np.save(os.path.join(out, filename), values)
+        columns.append({'name': name, 'file': filename, 'categories': categories})
+
+    # meta.json goes last and in one step: until it is replaced, loaders
+    # read the previous build's complete store, or none at all.
+    fd, tmp = tempfile.mkstemp(dir=out, suffix='.json.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'format': FORMAT,
+                   'source': source_signature(csv_path),
+                   'rows': len(df),
+                   'columns': columns}, f)
+    os.replace(tmp, os.path.join(out, 'meta.json'))
+    current = {col['file'] for col in columns}
+    for filename in os.listdir(out):
+        if filename.endswith('.npy') and filename not in current:
+            os.remove(os.path.join(out, filename))
+    return out
+
+
+def is_fresh(csv_path, path=None):
+    path = path or store_path(csv_path)
+    try:
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return meta.get('format') == FORMAT and meta['source'] == source_signature(csv_path)
+
+
+def load_store(path):
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    columns = {}
+    for col in meta['columns']:
+        values = np.load(os.path.join(path, col['file']), mmap_mode='r')
+        if col['categories'] is not None:
+            values = pd.Categorical.from_codes(values, col['categories'])
+        columns[col['name']] = values
+    # copy=False keeps the numeric columns as read-only memory maps, so every
+    # process loading the same store shares their pages through the OS cache.
+    return pd.DataFrame(columns, copy=False)
+
+
+def load(csv_path):
+    """The transactions with derived columns, from the store when fresh."""
+    path = store_path(csv_path)
+    if is_fresh(csv_path, path):
+        return load_store(path)
+    return derive(read_csv(csv_path))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('csv', nargs='?', default='cleaned_df.csv')
+    parser.add_argument('-o', '--out', help='store directory (default: <csv>.store)')
+    args = parser.parse_args(argv)
+    print(build(args.csv, args.out))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,91 @@
+# Gunicorn settings for `gunicorn -c gunicorn.conf.py sidebar:server`.
+#
+# The app is preloaded: sidebar.py (the dataset, the aggregate cube and the
+# static figures) is imported once in the master before it forks, and every
+# worker maps the same pages copy-on-write instead of holding its own copy.
+# Set GUNICORN_PRELOAD=0 to import the app in each worker instead.
+
+import gc
+import os
+
+import datastore
+import aggregates
+import sampling
+
+bind = '0.0.0.0:' + os.environ.get('PORT', '8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') != '0'
+
+# Threaded workers. A sync worker is tied up for as long as one client takes
+# to send its request and read the response, so a few slow connections can
+# hold every worker. A gthread worker waits for requests without a thread,
+# serves up to GUNICORN_THREADS at once and keeps idle connections alive.
+# The callbacks are CPU bound and share one interpreter per worker, so the
+# threads add no compute: WEB_CONCURRENCY workers still set that. gevent
+# would gain nothing more, since a callback would block its event loop.
+# GUNICORN_WORKER_CLASS=sync restores the old workers.
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+
+# Build the columnar store before the app is imported so the dataset is
+# loaded as memory maps, which stay shared even without preloading. With
+# DATA_MODE=aggregates no rows are loaded; the saved aggregates, and the
+# sample with SAMPLE_ROWS set, are brought up to date instead, once rather
+# than in every worker.
+_data_file = os.environ.get('DATA_FILE', 'cleaned_df.csv')
+if os.environ.get('DATA_MODE') == 'aggregates':
+    _memory_limit = int(os.environ.get('AGGREGATE_MEMORY', 2**30))
+    aggregates.load(_data_file, int(os.environ.get('AGGREGATE_JOBS', 0)) or None, _memory_limit)
+    if int(os.environ.get('SAMPLE_ROWS', 0)):
+        sampling.load(_data_file, int(os.environ['SAMPLE_ROWS']), memory_limit=_memory_limit)
+elif not datastore.is_fresh(_data_file):
+    datastore.build(_data_file)
+
+
+def unique_rss(pid='self'):
+    """Bytes of memory private to process ``pid`` (its USS), this one by
+    default. Linux only."""
+    total = 0
+    try:
+        with open('/proc/{}/smaps_rollup'.format(pid)) as f:
+            for line in f:
+                if line.startswith(('Private_Clean:', 'Private_Dirty:')):
+                    total += int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return total
+
+
+def when_ready(server):
+    # Pages are built and serialized lazily; with the app preloaded, do it
+    # here in the master so the workers inherit them instead of each
+    # building their own.
+    # Batches already waiting in INGEST_DIR are folded in first, so the
+    # workers start from them too.
+    if preload_app:
+        import sidebar
+        if sidebar.INGEST_DIR:
+            sidebar.ingest_pending()
+        for pathname in sidebar.PAGES:
+            sidebar.page_response(pathname)
+
+
+def pre_fork(server, worker):
+    # Keep the garbage collector from touching the preloaded objects in the
+    # workers; collecting them would write to and un-share their pages.
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    # Cross-filter passes in aggregates mode go to a process pool. Fork it
+    # now, before the worker starts its threads, rather than from a fork
+    # server that imports the app again in every process of every pass.
+    if os.environ.get('DATA_MODE') == 'aggregates':
+        aggregates.start_pool(int(os.environ.get('AGGREGATE_JOBS', 0)) or None)
+
+
+def post_worker_init(worker):
+    rss = unique_rss()
+    if rss is not None:
+        worker.log.info('Worker %s unique RSS: %.1f MiB', worker.pid, rss / 2**20)
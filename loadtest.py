@@ -0,0 +1,554 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Load-test the dashboard by replaying browser sessions against it.
+
+``python loadtest.py http://127.0.0.1:8000 -c 20 -d 60`` runs 20 simulated
+users for a minute, each playing sessions back to back. A user does what the
+Dash renderer does in a browser tab. It loads the page, the layout and the
+callback graph. Then, for each step of the session, it sets component
+properties: a route change, a tab click, a dropdown selection, or a click on
+the map or a bar. For every server-side callback the change triggers, it
+POSTs /_dash-update-component in dependency order and applies the response to
+its copy of the layout. New components get their initial callbacks too, just
+as they do in the browser. Callbacks that run in the browser (the home page
+tabs redrawing ``subplot`` and ``bar``) make no requests. Requests are sent
+one at a time per user, and static assets are not fetched, since a browser
+caches them.
+
+A session is a JSON list of steps. ``{"set": {"tabs.value": "Quantity"}}``
+sets properties, and ``{"post": {...}}`` sends a recorded request body as it
+is. Sessions start once the home page has loaded. ``SESSION`` below visits
+every page, and ``--session FILE`` plays your own. ``--record FILE`` starts
+a proxy in front of the server that saves what a real browser sends as such
+a session.
+
+``--configs sync:2x1 2x8`` starts gunicorn locally (with gunicorn.conf.py)
+for each [WORKER_CLASS:]WORKERSxTHREADS configuration in turn and tests
+each one. ``--slow N`` adds N users on slow links, which send and read
+``--slow-rate`` bytes a second. The report gives requests per second, and
+the p50/p95/p99 latency of each callback in milliseconds, with the slow
+users' requests reported apart, and for a local server the unique RSS of
+each worker after the test. ``-o FILE`` saves it as JSON.
+"""
+
+import os
+import sys
+import json
+import gzip
+import time
+import random
+import socket
+import argparse
+import tempfile
+import importlib.util
+import threading
+import subprocess
+import http.client
+import urllib.parse
+from collections import Counter, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+
+# Sessions start with the home page loaded
+SESSION = [
+    {'set': {'radio_options.value': 'Profit'}},
+    {'set': {'map.clickData': {'points': [{'location': 'CA'}]}}},
+    {'set': {'subplot.clickData': {'points': [{'curveNumber': 3, 'x': 'Technology'}]}}},
+    {'set': {'bar.clickData': {'points': [{'x': 'California'}]}}},
+    {'set': {'url.pathname': '/page-1'}},
+    {'set': {'product-dropdown.value': 'Chairs'}},
+    {'set': {'tabs.value': 'Quantity'}},
+    {'set': {'product-dropdown.value': 'Phones'}},
+    {'set': {'url.pathname': '/'}},
+    {'set': {'clear-selection.n_clicks': 1}},
+    {'set': {'url.pathname': '/page-2'}},
+]
+TIMEOUT = 60
+# Slow clients send and read this many bytes at a time
+SLOW_CHUNK = 512
+HOP_BY_HOP = {'connection', 'keep-alive', 'proxy-connection', 'te', 'trailer',
+              'transfer-encoding', 'upgrade', 'host', 'content-length'}
+
+
+class RequestFailed(Exception):
+    pass
+
+
+def parse_outputs(output):
+    """The ``outputs`` of a request body, from a callback's ``output`` key."""
+    if output.startswith('..'):
+        return [dict(zip(('id', 'property'), part.rsplit('.', 1))) for part in output[2:-2].split('...')]
+    return dict(zip(('id', 'property'), output.rsplit('.', 1)))
+
+
+def label(output):
+    # '..subplot.figure...bar.figure..' -> 'subplot.figure+bar.figure'
+    return output.strip('.').replace('...', '+')
+
+
+class Results:
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.bytes = defaultdict(int)
+        self.errors = Counter()
+        self.sessions = 0
+
+    def merge(self, other):
+        for name, samples in other.latencies.items():
+            self.latencies[name] += samples
+        for name, size in other.bytes.items():
+            self.bytes[name] += size
+        self.errors.update(other.errors)
+        self.sessions += other.sessions
+
+    def summary(self, seconds):
+        def percentiles(samples):
+            ms = np.array(samples) * 1000
+            return {'p50': round(float(np.percentile(ms, 50)), 1),
+                    'p95': round(float(np.percentile(ms, 95)), 1),
+                    'p99': round(float(np.percentile(ms, 99)), 1)}
+
+        everything = [s for samples in self.latencies.values() for s in samples]
+        callbacks = {name: dict(n=len(samples), per_s=round(len(samples) / seconds, 2),
+                                mean_bytes=self.bytes[name] // len(samples), **percentiles(samples))
+                     for name, samples in sorted(self.latencies.items())}
+        return dict({'seconds': round(seconds, 1), 'sessions': self.sessions, 'requests': len(everything),
+                     'per_s': round(len(everything) / seconds, 2), 'errors': dict(self.errors)},
+                    **(percentiles(everything) if everything else {}), callbacks=callbacks)
+
+
+class SlowConnection(http.client.HTTPConnection):
+    """A connection over a slow link, sending ``rate`` bytes a second. With
+    a small receive buffer, the server can't send much faster than the
+    client reads either."""
+
+    def __init__(self, host, port, rate, timeout=TIMEOUT):
+        super().__init__(host, port, timeout=timeout)
+        self.rate = rate
+
+    def connect(self):
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * SLOW_CHUNK)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect((self.host, self.port))
+
+    def send(self, data):
+        for i in range(0, len(data), SLOW_CHUNK):
+            super().send(data[i:i + SLOW_CHUNK])
+            time.sleep(SLOW_CHUNK / self.rate)
+
+
+class Client:
+    """A keep-alive connection to the server that times every request.
+    Given a ``rate`` in bytes per second, a slow one."""
+
+    def __init__(self, base_url, results, rate=None):
+        url = urllib.parse.urlsplit(base_url)
+        self.prefix = url.path.rstrip('/')
+        if rate:
+            self.conn = SlowConnection(url.hostname, url.port or 80, rate)
+        else:
+            self.conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=TIMEOUT)
+        self.rate = rate
+        self.results = results
+
+    def _read(self, response):
+        if not self.rate:
+            return response.read()
+        chunks = []
+        while True:
+            chunk = response.read(SLOW_CHUNK)
+            if not chunk:
+                return b''.join(chunks)
+            chunks.append(chunk)
+            time.sleep(len(chunk) / self.rate)
+
+    def request(self, name, method, path, body=None):
+        headers = {'Accept-Encoding': 'gzip'}
+        if body is not None:
+            body = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+        for retry in (False, True):
+            start = time.perf_counter()
+            try:
+                self.conn.request(method, self.prefix + path, body, headers)
+                response = self.conn.getresponse()
+                data = self._read(response)
+                break
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError) as e:
+                # the server may close a kept-alive connection between
+                # requests; retry once on a new one
+                self.conn.close()
+                if retry:
+                    self.results.errors['{}: {}'.format(name, type(e).__name__)] += 1
+                    raise RequestFailed(name) from e
+            except (OSError, http.client.HTTPException) as e:
+                self.conn.close()
+                self.results.errors['{}: {}'.format(name, type(e).__name__)] += 1
+                raise RequestFailed(name) from e
+        elapsed = time.perf_counter() - start
+        if response.status >= 400:
+            self.results.errors['{}: HTTP {}'.format(name, response.status)] += 1
+            raise RequestFailed(name)
+        self.results.latencies[name].append(elapsed)
+        self.results.bytes[name] += len(data)
+        if response.getheader('Content-Encoding') == 'gzip':
+            data = gzip.decompress(data)
+        return response.status, data
+
+    def get(self, path):
+        return self.request('GET ' + path, 'GET', path)[1]
+
+    def post(self, body):
+        """Calls a callback; returns the properties it set, by component id."""
+        status, data = self.request(label(body['output']), 'POST', '/_dash-update-component', body)
+        # 204: the callback raised PreventUpdate
+        return json.loads(data)['response'] if status == 200 else {}
+
+
+class Page:
+    """The layout a browser tab holds, and the server-side callbacks on it."""
+
+    def __init__(self, client, layout, dependencies):
+        self.client = client
+        self.layout = layout
+        self.callbacks = [cb for cb in dependencies if not cb.get('clientside_function')]
+        for cb in self.callbacks:
+            cb['outputs'] = parse_outputs(cb['output'])
+            outputs = cb['outputs'] if isinstance(cb['outputs'], list) else [cb['outputs']]
+            cb['ids'] = {dep['id'] for dep in outputs + cb['inputs'] + cb['state']}
+            cb['sets'] = {'{}.{}'.format(dep['id'], dep['property']) for dep in outputs}
+            cb['reads'] = {'{}.{}'.format(dep['id'], dep['property']) for dep in cb['inputs']}
+        self.components = {}
+        self._index(layout)
+
+    def load(self, pathname):
+        """Open the app at ``pathname``, as the renderer does on load."""
+        for component in self.components.values():
+            if component['type'] == 'Location':
+                component['props']['pathname'] = pathname
+        self.run(self._initial_calls(set(self.components)))
+
+    def _index(self, node):
+        if isinstance(node, list):
+            for child in node:
+                self._index(child)
+        elif isinstance(node, dict) and 'props' in node:
+            if 'id' in node['props']:
+                self.components[node['props']['id']] = node
+            self._index(node['props'].get('children'))
+
+    def _ready(self, cb):
+        return cb['ids'] <= self.components.keys()
+
+    def _initial_calls(self, ids):
+        # the renderer calls back for components as they are added
+        return {i: set() for i, cb in enumerate(self.callbacks)
+                if cb['ids'] & ids and self._ready(cb) and not cb.get('prevent_initial_call')}
+
+    def _triggered(self, changed):
+        calls = {}
+        for i, cb in enumerate(self.callbacks):
+            props = cb['reads'] & changed
+            if props and self._ready(cb):
+                calls[i] = props
+        return calls
+
+    def set(self, props):
+        """Set ``{"id.property": value}`` as the user would, and run the
+        callbacks that triggers."""
+        for prop, value in props.items():
+            id, name = prop.rsplit('.', 1)
+            if id not in self.components:
+                raise ValueError('{} is not in the layout'.format(id))
+            self.components[id]['props'][name] = value
+        self.run(self._triggered(set(props)))
+
+    def run(self, calls):
+        calls = dict(calls)
+        while calls:
+            # a callback waits while another one queued sets its inputs
+            pending = set().union(*(self.callbacks[i]['sets'] for i in calls))
+            i = next((i for i in calls if not self.callbacks[i]['reads'] & (pending - self.callbacks[i]['sets'])),
+                     next(iter(calls)))
+            changed_ids = calls.pop(i)
+            cb = self.callbacks[i]
+            if not self._ready(cb):
+                continue
+            value = lambda dep: dict(dep, value=self.components[dep['id']]['props'].get(dep['property']))
+            response = self.client.post({'output': cb['output'], 'outputs': cb['outputs'],
+                                         'inputs': [value(dep) for dep in cb['inputs']],
+                                         'state': [value(dep) for dep in cb['state']],
+                                         'changedPropIds': sorted(changed_ids)})
+            changed = set()
+            before = set(self.components)
+            for id, props in response.items():
+                if id in self.components:
+                    self.components[id]['props'].update(props)
+                    changed |= {'{}.{}'.format(id, prop) for prop in props}
+            if any('children' in props for props in response.values()):
+                self.components = {}
+                self._index(self.layout)
+            for j, props in list(self._initial_calls(set(self.components) - before).items()) + \
+                            list(self._triggered(changed).items()):
+                calls.setdefault(j, set()).update(props)
+
+
+def play(client, steps, deadline, think):
+    client.get('/')
+    layout = json.loads(client.get('/_dash-layout'))
+    page = Page(client, layout, json.loads(client.get('/_dash-dependencies')))
+    # a recorded session has the requests of the first load already
+    if not any('post' in step for step in steps):
+        page.load('/')
+    for step in steps:
+        if time.monotonic() >= deadline:
+            return False
+        if think:
+            time.sleep(think)
+        if 'post' in step:
+            client.post(step['post'])
+        else:
+            page.set(step['set'])
+    return True
+
+
+def user(base_url, sessions, deadline, think, results, seed, rate=None):
+    rng = random.Random(seed)
+    client = Client(base_url, results, rate)
+    while time.monotonic() < deadline:
+        try:
+            if play(client, rng.choice(sessions), deadline, think):
+                results.sessions += 1
+        except RequestFailed:
+            # counted where it failed; the user starts over
+            pass
+
+
+def load_test(base_url, sessions, concurrency, duration, think=0, seed=0, slow=0, slow_rate=None):
+    """Run ``concurrency`` users, plus ``slow`` ones on links of
+    ``slow_rate`` bytes a second, reported apart."""
+    per_user = [Results() for _ in range(concurrency + slow)]
+    start = time.monotonic()
+    deadline = start + duration
+    threads = [threading.Thread(target=user, args=(base_url, sessions, deadline, think, per_user[i], seed + i,
+                                                   slow_rate if i >= concurrency else None),
+                                daemon=True)
+               for i in range(concurrency + slow)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.monotonic() - start
+    results, slow_results = Results(), Results()
+    for i, part in enumerate(per_user):
+        (results if i < concurrency else slow_results).merge(part)
+    summary = results.summary(seconds)
+    if slow:
+        summary['slow'] = slow_results.summary(seconds)
+    return summary
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def serve(config, start_timeout):
+    """Start gunicorn as [WORKER_CLASS:]WORKERSxTHREADS; returns the
+    process and its URL."""
+    worker_class, _, size = config.rpartition(':')
+    workers, threads = size.split('x')
+    port = free_port()
+    log = tempfile.TemporaryFile()
+    here = os.path.dirname(os.path.abspath(__file__))
+    options = ['--worker-class', worker_class] if worker_class else []
+    process = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', *options,
+                                '--workers', workers, '--threads', threads,
+                                '--bind', '127.0.0.1:{}'.format(port), 'sidebar:server'],
+                               cwd=here, stdout=log, stderr=subprocess.STDOUT)
+    url = 'http://127.0.0.1:{}'.format(port)
+    deadline = time.monotonic() + start_timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            break
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            conn.request('GET', '/_dash-layout')
+            if conn.getresponse().status == 200:
+                return process, url
+        except OSError:
+            pass
+        time.sleep(0.5)
+    stop(process)
+    log.seek(0)
+    raise SystemExit('gunicorn {} did not start:\n{}'.format(config, log.read().decode(errors='replace')[-2000:]))
+
+
+def gunicorn_config():
+    """gunicorn.conf.py, loaded as a module."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    spec = importlib.util.spec_from_file_location('gunicorn_conf', os.path.join(here, 'gunicorn.conf.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def children(pid):
+    """Pids of the processes ``pid`` started, Linux only: gunicorn's workers."""
+    pids = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(entry)) as f:
+                # the parent pid is the second field after the command name
+                fields = f.read().rpartition(')')[2].split()
+        except OSError:
+            continue
+        if int(fields[1]) == pid:
+            pids.append(int(entry))
+    return sorted(pids)
+
+
+def workers_unique_rss(process):
+    """MiB private to each of the workers of gunicorn ``process``."""
+    unique_rss = gunicorn_config().unique_rss
+    sizes = (unique_rss(pid) for pid in children(process.pid))
+    return [round(size / 2**20, 1) for size in sizes if size is not None]
+
+
+def stop(process):
+    process.terminate()
+    try:
+        process.wait(30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def record(base_url, port, out):
+    """Proxy ``base_url`` on ``port`` and save the callback requests the
+    browser sends through it to ``out`` as a session."""
+    url = urllib.parse.urlsplit(base_url)
+    prefix = url.path.rstrip('/')
+    steps = []
+
+    class Proxy(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            self.forward()
+
+        def do_POST(self):
+            self.forward()
+
+        def forward(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length) if length else None
+            headers = {k: v for k, v in self.headers.items() if k.lower() not in HOP_BY_HOP}
+            conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=TIMEOUT)
+            conn.request(self.command, prefix + self.path, body, headers)
+            response = conn.getresponse()
+            data = response.read()
+            if self.command == 'POST' and self.path.endswith('/_dash-update-component'):
+                steps.append({'post': json.loads(body)})
+            self.send_response(response.status)
+            for k, v in response.getheaders():
+                if k.lower() not in HOP_BY_HOP:
+                    self.send_header(k, v)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), Proxy)
+    print('Recording: browse http://127.0.0.1:{}/ then press Ctrl-C to save.'.format(port), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    with open(out, 'w') as f:
+        json.dump(steps, f, indent=1)
+    print('{}: {} requests'.format(out, len(steps)))
+
+
+def report(results):
+    line = '{:<10} {:<60} {:>7} {:>9} {:>9} {:>9} {:>9}'
+    print(line.format('config', 'callback', 'n', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for config, result in results.items():
+        rows = [(name, r['n'], r) for name, r in result['callbacks'].items()]
+        rows.append(('all', result['requests'], result))
+        if 'slow' in result:
+            rows.append(('all, slow clients', result['slow']['requests'], result['slow']))
+        for name, n, r in rows:
+            print(line.format(config, name, n, r['per_s'], r.get('p50', ''), r.get('p95', ''), r.get('p99', '')))
+        for error, n in result['errors'].items():
+            print('{:<10} error: {} x{}'.format(config, error, n))
+        if result.get('workers_unique_rss_mib'):
+            print('{:<10} workers\' unique RSS after the test (MiB): {}'.format(
+                config, ', '.join(map(str, result['workers_unique_rss_mib']))))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('url', nargs='?', default='http://127.0.0.1:8000')
+    parser.add_argument('-c', '--concurrency', type=int, default=10, help='simulated users (default: 10)')
+    parser.add_argument('-d', '--duration', type=float, default=30, help='seconds per test (default: 30)')
+    parser.add_argument('--think', type=float, default=0, help='seconds users wait between steps (default: 0)')
+    parser.add_argument('--session', action='append', metavar='FILE',
+                        help='session to play, chosen at random when given more than once (default: SESSION)')
+    parser.add_argument('--slow', type=int, default=0,
+                        help='slow clients added to the users, reported apart (default: 0)')
+    parser.add_argument('--slow-rate', type=float, default=20000,
+                        help='bytes a second a slow client sends and reads (default: 20000)')
+    parser.add_argument('--configs', nargs='+', metavar='[CLASS:]WORKERSxTHREADS',
+                        help='start gunicorn locally with each configuration instead of testing URL')
+    parser.add_argument('--start-timeout', type=float, default=600, help='seconds to wait for gunicorn (default: 600)')
+    parser.add_argument('--record', metavar='FILE', help='record a browser session through a proxy to URL')
+    parser.add_argument('--proxy-port', type=int, default=8050, help='port of the recording proxy (default: 8050)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--out', help='save the results as JSON')
+    args = parser.parse_args(argv)
+
+    if args.record:
+        return record(args.url, args.proxy_port, args.record)
+    sessions = [SESSION]
+    if args.session:
+        sessions = []
+        for path in args.session:
+            with open(path) as f:
+                sessions.append(json.load(f))
+
+    results = {}
+    for config in args.configs or [None]:
+        if config is None:
+            process, url = None, args.url
+        else:
+            print('starting gunicorn {}'.format(config), file=sys.stderr)
+            process, url = serve(config, args.start_timeout)
+        try:
+            results[config or url] = load_test(url, sessions, args.concurrency, args.duration, args.think,
+                                               args.seed, args.slow, args.slow_rate)
+            if process is not None:
+                results[config]['workers_unique_rss_mib'] = workers_unique_rss(process)
+        finally:
+            if process is not None:
+                stop(process)
+    report(results)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump({'date': time.strftime('%Y-%m-%dT%H:%M:%S%z'), 'concurrency': args.concurrency,
+                       'slow': args.slow, 'slow_rate': args.slow_rate, 'duration': args.duration,
+                       'think': args.think, 'results': results}, f, indent=1)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Counters, gauges and histograms in the Prometheus text format.
+
+A small stand-in for prometheus_client, enough for the dashboard's own
+instrumentation. Every gunicorn worker keeps its own ``Registry``. Given a
+``directory`` shared by the workers, each one saves a snapshot there at
+most ``interval`` seconds after its values change, and ``render`` adds the
+other workers' snapshots to its own live values, each labelled with its
+pid. Any worker can then answer a scrape for all of them.
+"""
+
+import os
+import json
+import time
+import tempfile
+import threading
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BYTES_BUCKETS = (2**10, 2**12, 2**14, 2**16, 2**18, 2**20, 2**22, 2**24)
+
+
+def rss_bytes():
+    """Resident set size of this process, Linux only."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in labels) + '}'
+
+
+class Registry:
+
+    def __init__(self, directory=None, interval=1.0):
+        self.directory = directory
+        self.interval = interval
+        self._help = {}
+        self._types = {}
+        self._buckets = {}
+        self._values = {}  # (name, labels) -> value, or [bucket counts, sum, count]
+        self._gauges = {}  # name -> function of no arguments
+        self._lock = threading.Lock()
+        self._saved = 0
+        self._timer = None
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def counter(self, name, help):
+        self._help[name], self._types[name] = help, 'counter'
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        self._help[name], self._types[name] = help, 'histogram'
+        self._buckets[name] = buckets
+
+    def gauge(self, name, help, func):
+        """``func`` returns the value, or {labels: value}, at scrape time."""
+        self._help[name], self._types[name] = help, 'gauge'
+        self._gauges[name] = func
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, tuple(labels))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+        self._maybe_save()
+
+    def observe(self, name, value, labels=()):
+        key = (name, tuple(labels))
+        buckets = self._buckets[name]
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(buckets), 0.0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+        self._maybe_save()
+
+    def snapshot(self):
+        with self._lock:
+            values = [[name, labels, value if not isinstance(value, list) else [list(value[0]), value[1], value[2]]]
+                      for (name, labels), value in self._values.items()]
+        for name, func in self._gauges.items():
+            value = func()
+            if value is None:
+                continue
+            for labels, v in (value.items() if isinstance(value, dict) else [((), value)]):
+                values.append([name, labels, v])
+        return values
+
+    def _maybe_save(self):
+        if not self.directory:
+            return
+        wait = self._saved + self.interval - time.monotonic()
+        if wait <= 0:
+            self._save()
+        elif self._timer is None:
+            # save what changes until then, even if nothing else happens
+            self._timer = threading.Timer(wait, self._save)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _save(self):
+        self._timer = None
+        self._saved = time.monotonic()
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp, os.path.join(self.directory, '{}.json'.format(os.getpid())))
+
+    def _workers(self):
+        """Every worker's values, labelled by pid: this one's live, the
+        others' from their last snapshot. Snapshots of exited workers are
+        removed."""
+        pid = os.getpid()
+        if not self.directory:
+            return [(None, self.snapshot())]
+        workers = [(pid, self.snapshot())]
+        for entry in os.scandir(self.directory):
+            name, ext = os.path.splitext(entry.name)
+            if ext != '.json' or not name.isdigit() or int(name) == pid:
+                continue
+            try:
+                os.kill(int(name), 0)
+            except ProcessLookupError:
+                os.remove(entry.path)
+                continue
+            except PermissionError:
+                pass
+            try:
+                with open(entry.path) as f:
+                    workers.append((int(name), json.load(f)))
+            except (OSError, ValueError):
+                pass
+        return workers
+
+    def render(self):
+        series = {}
+        for pid, values in self._workers():
+            for name, labels, value in values:
+                labels = [tuple(pair) for pair in labels]
+                if pid is not None:
+                    labels.append(('pid', pid))
+                series.setdefault(name, []).append((labels, value))
+        lines = []
+        for name in sorted(series):
+            lines.append('# HELP {} {}'.format(name, self._help.get(name, '')))
+            lines.append('# TYPE {} {}'.format(name, self._types.get(name, 'untyped')))
+            for labels, value in series[name]:
+                if self._types.get(name) != 'histogram':
+                    lines.append('{}{} {}'.format(name, _labels(labels), value))
+                    continue
+                counts, total, count = value
+                for bound, n in zip(self._buckets[name], counts):
+                    lines.append('{}_bucket{} {}'.format(name, _labels(labels + [('le', bound)]), n))
+                lines.append('{}_bucket{} {}'.format(name, _labels(labels + [('le', '+Inf')]), count))
+                lines.append('{}_sum{} {}'.format(name, _labels(labels), total))
+                lines.append('{}_count{} {}'.format(name, _labels(labels), count))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Precompute the dashboard's callback responses into a bundle.
+
+The inputs the dashboard can receive are few. There are three routed pages,
+two page-1 tabs times the sub-categories (or none) in the product dropdown,
+and the selections made by clicking the home page charts. ``python
+precompute.py cleaned_df.csv`` enumerates them. It has the app answer each
+request once and saves the response bodies, already compressed, to
+``precomputed/<data hash>-<code hash>.pkl``. The data hash is the SHA-256 of
+the CSV. The code hash covers the modules that draw the figures and the
+versions of the libraries they use. A bundle is therefore only used with
+the data and the code it was built from.
+
+The app loads the matching bundle from PRECOMPUTED_DIR at startup. It
+answers the requests found in the bundle by lookup, and computes any others
+as usual. ``--depth`` sets how many values a selection may combine (default:
+1, so every single-value selection). Each extra level multiplies the
+bundle's size.
+"""
+
+import os
+import sys
+import json
+import glob
+import pickle
+import hashlib
+import argparse
+import tempfile
+import itertools
+
+
+FORMAT = 1
+CODE_FILES = ['sidebar.py', 'aggregates.py', 'datastore.py', 'precompute.py', 'sampling.py']
+LIBRARIES = ['dash', 'dash_core_components', 'dash_html_components', 'dash_bootstrap_components',
+             'plotly', 'pandas', 'numpy']
+TABS = ['Profit', 'Quantity']
+# Besides the pages and heat, the callbacks of the selection whose response
+# depends on nothing else. update_selection reads its trigger and state, and
+# with nothing selected so do filter_home and filter_profit_page; those
+# requests are never bundled.
+SELECTION_OUTPUTS = ['selection-label.children', 'selection-note.children']
+SELECTED_OUTPUTS = ['..home-aggregates.data...map.figure...home-exact.disabled..', '..sunburst.figure...box.figure..']
+HEAT_OUTPUT = '..heat.figure...heat-exact.disabled..'
+
+
+def data_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def code_hash():
+    digest = hashlib.sha256()
+    here = os.path.dirname(os.path.abspath(__file__))
+    for name in CODE_FILES:
+        with open(os.path.join(here, name), 'rb') as f:
+            digest.update(f.read())
+    for name in LIBRARIES:
+        digest.update('{}={};'.format(name, __import__(name).__version__).encode())
+    return digest.hexdigest()
+
+
+def bundle_name(data_file):
+    return '{}-{}.pkl'.format(data_hash(data_file)[:16], code_hash()[:16])
+
+
+def request_key(payload):
+    """What identifies a callback request's response: the output and the
+    input and state values. Not the trigger, which none of the bundled
+    callbacks read, nor the ticks of the intervals polling for exact
+    results, which the bundled ones all are."""
+    values = lambda deps: [dep.get('value') for dep in deps or [] if dep.get('property') != 'n_intervals']
+    # sorted keys: the browser may send a selection's in any order
+    raw = json.dumps([payload.get('output'), values(payload.get('inputs')), values(payload.get('state'))],
+                     sort_keys=True)
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+def load(directory, data_file):
+    """The entries of the bundle built from ``data_file`` and this code, or
+    None. The data is only hashed when the directory holds bundles."""
+    if not glob.glob(os.path.join(directory, '*.pkl')):
+        return None
+    try:
+        with open(os.path.join(directory, bundle_name(data_file)), 'rb') as f:
+            bundle = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+    return bundle['entries'] if bundle.get('format') == FORMAT else None
+
+
+def selections(app, depth):
+    """{} and every selection of up to ``depth`` values that clicking the
+    home page charts can make, one value per dimension."""
+    values = [('State', state) for state in app.states['State']]
+    values += [(dim, value) for dim, *_ in app.PANELS for value in app.cube[dim][dim]]
+    values = [(dim, str(value)) for dim, value in values]
+    yield {}
+    for n in range(1, depth + 1):
+        for combination in itertools.combinations(values, n):
+            if len({dim for dim, _ in combination}) == n:
+                yield dict(combination)
+
+
+def bodies(app, depth):
+    """The request bodies the bundle answers, as the browser sends them."""
+    def body(output, values):
+        callback = app.app.callback_map[output]
+        # intervals' ticks are left None
+        dep = lambda d: dict(d, value=values.get('{}.{}'.format(d['id'], d['property'])))
+        outputs = [dict(zip(('id', 'property'), o.rsplit('.', 1))) for o in output.strip('.').split('...')]
+        return {'output': output, 'outputs': outputs if output.startswith('..') else outputs[0],
+                'inputs': [dep(d) for d in callback['inputs']], 'state': [dep(d) for d in callback['state']],
+                'changedPropIds': []}
+
+    for pathname in app.PAGES:
+        yield body('page-content.children', {'url.pathname': pathname})
+    products = [None] + sorted(app.discount_tensor['Sub-Category'][0])
+    for selection in selections(app, depth):
+        for tab, product in itertools.product(TABS, products):
+            yield body(HEAT_OUTPUT, {'tabs.value': tab, 'product-dropdown.value': product,
+                                     'selection.data': selection})
+        for output in SELECTION_OUTPUTS + (SELECTED_OUTPUTS if selection else []):
+            yield body(output, {'selection.data': selection})
+
+
+def build(data_file, directory='precomputed', depth=1):
+    """Answer every request of bodies() and save the bundle; returns its path."""
+    os.environ['DATA_FILE'] = data_file
+    # answered live and exactly, not from an older bundle or a sample;
+    # cached nowhere that lasts
+    os.environ['PRECOMPUTED_DIR'] = ''
+    os.environ['SAMPLE_ROWS'] = '0'
+    os.environ['CACHE_DIR'] = tempfile.mkdtemp(prefix='precompute-cache-')
+    import sidebar
+    client = sidebar.server.test_client()
+    entries = {}
+    for payload in bodies(sidebar, depth):
+        response = client.post('/_dash-update-component', json=payload, headers={'Accept-Encoding': 'identity'})
+        if response.status_code == 200:
+            entries[request_key(payload)] = sidebar.compressed(response.data)
+        elif response.status_code != 204:
+            raise RuntimeError('{} answered {}'.format(payload['output'], response.status_code))
+
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, bundle_name(data_file))
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        pickle.dump({'format': FORMAT, 'data': data_hash(data_file), 'code': code_hash(),
+                     'depth': depth, 'entries': entries}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+    return path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('csv', nargs='?', default='cleaned_df.csv')
+    parser.add_argument('-o', '--out', default='precomputed', help='bundle directory (default: precomputed)')
+    parser.add_argument('--depth', type=int, default=1, help='values a selection may combine (default: 1)')
+    args = parser.parse_args(argv)
+    print(build(args.csv, args.out, args.depth))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
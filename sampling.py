@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Stratified samples of the transactions, for approximate answers.
+
+With SAMPLE_ROWS set, the app keeps a sample of about that many rows and
+answers a cross-filter selection from it at once, before the exact answer
+is ready. The sample is stratified by Region and Category. Every row gets a
+uniform random key, and the sample keeps the SAMPLE_ROWS smallest keys
+overall, plus the MIN_STRATUM smallest of every stratum so that none is
+left with too few rows. Within each stratum that is a simple random sample,
+and each sampled row stands for N_h / n_h rows of its stratum (N_h rows in
+the stratum, n_h of them sampled).
+
+``StratifiedSample.group_by`` estimates the sidebar's group_by tables: the
+sums by Horvitz-Thompson, the means and the margin as ratios of them. The
+half-widths of their 95% confidence intervals come from the stratified
+variance, with the ratios linearized. Groups with fewer than MIN_SUPPORT
+sampled rows are left out: with so few of these heavy-tailed sales and
+profits the intervals would not hold, so they wait for the exact answer.
+
+Keys are kept per row, so samples of blocks merge into the sample of the
+whole file: ``python sampling.py cleaned_df.csv --rows 100000`` draws one in
+a single pass over the CSV, for DATA_MODE=aggregates, and saves it next to
+it (``cleaned_df.sample.pkl``). ``--check`` instead draws ``--seeds``
+samples from the loaded rows and reports how often the intervals cover the
+exact values.
+"""
+
+import os
+import sys
+import pickle
+import argparse
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import datastore
+import aggregates
+
+
+STRATA = ['Region', 'Category']
+MIN_STRATUM = 100
+MIN_SUPPORT = 100
+# two-sided 95%
+Z = 1.96
+# what the dashboard filters and groups the sample on
+COLUMNS = ['State', 'state_code', 'Region', 'Segment', 'Ship Mode', 'Category', 'Sub-Category',
+           'Sales', 'Profit', 'Quantity', 'Discount']
+MEASURES = ['Sales', 'Profit', 'Quantity']
+
+# Saved samples of another format are drawn again
+FORMAT = 1
+
+
+def strata_codes(rows, strata):
+    """Each row's stratum, as its index in ``strata``, the (Region, Category)
+    pairs seen so far; pairs not seen yet are appended."""
+    region, category = (rows[col].astype('category').cat for col in STRATA)
+    lookup = np.empty((len(region.categories), len(category.categories)), dtype=np.intp)
+    for i, r in enumerate(region.categories):
+        for j, c in enumerate(category.categories):
+            if (r, c) not in strata:
+                strata.append((r, c))
+            lookup[i, j] = strata.index((r, c))
+    return lookup[region.codes.to_numpy(), category.codes.to_numpy()]
+
+
+def smallest(keys, codes, size, floor=MIN_STRATUM):
+    """Positions of the rows a sample keeps: the ``size`` smallest keys
+    overall, and at least the ``floor`` smallest of every stratum."""
+    if len(keys) <= size:
+        return np.arange(len(keys))
+    keep = np.zeros(len(keys), dtype=bool)
+    keep[np.argpartition(keys, size - 1)[:size]] = True
+    kept = np.bincount(codes[keep], minlength=codes.max() + 1)
+    total = np.bincount(codes, minlength=codes.max() + 1)
+    for stratum in np.flatnonzero(kept < np.minimum(total, floor)):
+        rows = np.flatnonzero(codes == stratum)
+        k = min(floor, len(rows))
+        keep[rows[np.argpartition(keys[rows], k - 1)[:k]]] = True
+    return np.flatnonzero(keep)
+
+
+class StratifiedSample:
+    """Sampled rows of the COLUMNS, with their stratum and key, and how many
+    rows each stratum has in the population."""
+
+    def __init__(self, rows, population, strata):
+        self.rows = rows.reset_index(drop=True)
+        self.population = np.asarray(population, dtype=float)
+        self.strata = strata
+        codes = self.rows['Stratum'].to_numpy()
+        self.sizes = np.bincount(codes, minlength=len(strata)).astype(float)
+        sampled = np.maximum(self.sizes, 1)
+        self.weights = self.population / sampled
+        # each stratum's share of the variance of a total, per unit of the
+        # sum of squared deviations of its sampled values; nothing for
+        # strata sampled whole
+        fpc = 1 - self.sizes / np.maximum(self.population, 1)
+        self.spread = np.where(self.sizes > 1, self.population**2 * fpc / (sampled * np.maximum(sampled - 1, 1)), 0)
+
+    @classmethod
+    def draw(cls, rows, size, seed=0):
+        """A sample of about ``size`` of ``rows``."""
+        strata = []
+        codes = strata_codes(rows, strata)
+        keys = np.random.default_rng(seed).random(len(rows))
+        keep = smallest(keys, codes, size)
+        sampled = rows[COLUMNS].take(keep).assign(Stratum=codes[keep], Key=keys[keep])
+        return cls(sampled, np.bincount(codes, minlength=len(strata)), strata)
+
+    def extend(self, rows, size, seed):
+        """The sample of the population grown by ``rows``. The new rows get
+        keys of their own and are merged in as ``build`` merges blocks, so
+        the whole population isn't drawn from again. ``seed`` must differ
+        from those of the rows already sampled."""
+        strata = list(self.strata)
+        codes = strata_codes(rows, strata)
+        keys = np.random.default_rng(seed).random(len(rows))
+        added = rows[COLUMNS].assign(Stratum=codes, Key=keys)
+        kept = self.rows.copy()
+        for col in COLUMNS:
+            if isinstance(kept[col].dtype, pd.CategoricalDtype) and isinstance(added[col].dtype, pd.CategoricalDtype):
+                known = kept[col].cat.categories
+                categories = known.append(added[col].cat.categories.difference(known))
+                kept[col] = kept[col].cat.set_categories(categories)
+                added[col] = added[col].cat.set_categories(categories)
+        merged = pd.concat([kept, added], ignore_index=True)
+        merged = merged.take(smallest(merged['Key'].to_numpy(), merged['Stratum'].to_numpy(), size))
+        population = np.pad(self.population, (0, len(strata) - len(self.population)))
+        population += np.bincount(codes, minlength=len(strata))
+        return type(self)(merged, population, strata)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def group_by(self, keys, selection=None):
+        """Estimates of the sidebar's ``group_by(select(selection), keys)``
+        with a ``<column> CI`` half-width for every column but the keys, for
+        the groups with at least MIN_SUPPORT sampled rows."""
+        keys = [keys] if isinstance(keys, str) else list(keys)
+        rows = aggregates.where(self.rows, selection or {})
+        groups = rows.groupby(keys, observed=True, sort=True)
+        support = groups.size().to_numpy()
+        table = groups.size().reset_index()[keys]
+        n_strata = len(self.strata)
+        cells = groups.ngroup().to_numpy() * n_strata + rows['Stratum'].to_numpy()
+
+        def moment(values):
+            # per group and stratum; rows outside a group count as zeros
+            return np.bincount(cells, weights=values, minlength=len(table) * n_strata).reshape(-1, n_strata)
+
+        def variance(first, second):
+            return np.maximum(second - first**2 / np.maximum(self.sizes, 1), 0) @ self.spread
+
+        values = {col: rows[col].to_numpy(dtype=float) for col in MEASURES + ['Discount']}
+        values['Transactions'] = np.ones(len(rows))
+        first = {col: moment(v) for col, v in values.items()}
+        totals = {col: m @ self.weights for col, m in first.items()}
+        for col in MEASURES + ['Transactions']:
+            table[col] = totals[col]
+            table[col + ' CI'] = Z * np.sqrt(variance(first[col], moment(values[col]**2)))
+
+        def ratio(y, x):
+            # the delta method: the variance of the total of y - R x, over X^2
+            r = totals[y] / totals[x]
+            residual = first[y] - r[:, None] * first[x]
+            squares = (moment(values[y]**2) - 2 * r[:, None] * moment(values[y] * values[x])
+                       + r[:, None]**2 * moment(values[x]**2))
+            return r, Z * np.sqrt(variance(residual, squares)) / np.abs(totals[x])
+
+        if 'Discount' not in keys:
+            table['Discount'], table['Discount CI'] = ratio('Discount', 'Transactions')
+        margin, margin_ci = ratio('Profit', 'Sales')
+        table['Gross PM'], table['Gross PM CI'] = (margin * 100).round(2), margin_ci * 100
+        for col in ['Quantity', 'Transactions']:
+            table[col] = table[col].round().astype(np.int64)
+        return table[support >= MIN_SUPPORT].reset_index(drop=True)
+
+
+def sample_path(csv_path):
+    return os.path.splitext(csv_path)[0] + '.sample.pkl'
+
+
+def build(csv_path, size, out=None, seed=0, memory_limit=2**30):
+    """Sample ``csv_path`` in one pass of bounded memory and save the
+    sample; returns its path."""
+    out = out or sample_path(csv_path)
+    rng = np.random.default_rng(seed)
+    strata = []
+    population = np.zeros(0)
+    kept = []
+    with open(csv_path, 'rb') as f:
+        header = f.readline()
+        for block in aggregates.blocks(f, max(memory_limit // aggregates.BLOCK_OVERHEAD, aggregates.MIN_BLOCK_BYTES)):
+            rows = aggregates.read_block(header, block)
+            codes = strata_codes(rows, strata)
+            keys = rng.random(len(rows))
+            population = np.pad(population, (0, len(strata) - len(population)))
+            population += np.bincount(codes, minlength=len(strata))
+            keep = smallest(keys, codes, size)
+            # as text: the blocks' categoricals have categories of their own
+            kept.append(rows[COLUMNS].take(keep).astype({col: str for col in COLUMNS[:7]})
+                        .assign(Stratum=codes[keep], Key=keys[keep]))
+            if len(kept) >= 8:
+                kept = [pd.concat(kept, ignore_index=True)]
+                kept[0] = kept[0].take(smallest(kept[0]['Key'].to_numpy(), kept[0]['Stratum'].to_numpy(), size))
+    if kept:
+        rows = pd.concat(kept, ignore_index=True)
+        rows = rows.take(smallest(rows['Key'].to_numpy(), rows['Stratum'].to_numpy(), size))
+    else:
+        rows = pd.DataFrame(columns=COLUMNS + ['Stratum', 'Key'])
+    # sorted categoricals, like the columns the in-memory path groups on
+    rows = rows.astype({col: 'category' for col in COLUMNS[:7]})
+    sample = StratifiedSample(rows, population, strata)
+
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(out)), suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        pickle.dump({'format': FORMAT, 'source': datastore.source_signature(csv_path),
+                     'size': size, 'seed': seed, 'sample': sample}, f)
+    os.replace(tmp, out)
+    return out
+
+
+def load(csv_path, size, seed=0, memory_limit=2**30):
+    """The saved sample of ``csv_path``, drawn first when stale or of
+    another size."""
+    path = sample_path(csv_path)
+    try:
+        with open(path, 'rb') as f:
+            saved = pickle.load(f)
+        if (saved.get('format') == FORMAT and saved['source'] == datastore.source_signature(csv_path)
+                and (saved['size'], saved['seed']) == (size, seed)):
+            return saved['sample']
+    except (OSError, EOFError, pickle.UnpicklingError):
+        pass
+    build(csv_path, size, path, seed, memory_limit)
+    with open(path, 'rb') as f:
+        return pickle.load(f)['sample']
+
+
+def check(rows, size, seeds=20):
+    """How often the 95% intervals of samples of ``rows`` cover the exact
+    values of the home page tables, for each single-value selection.
+    Returns {column: (covered, estimated)} and how many groups were left
+    out for want of sampled rows."""
+    selections = [{}] + [{dim: value} for dim in aggregates.DIMENSIONS + ['State']
+                         for value in rows[dim].cat.categories]
+    exact = {}
+    for i, selection in enumerate(selections):
+        selected = aggregates.where(rows, selection)
+        for dim in aggregates.DIMENSIONS:
+            table = aggregates.grouped_sums(selected, [dim])
+            table['Discount'] = table['Discount'] / table['Transactions']
+            table['Gross PM'] = table['Profit'] / table['Sales'] * 100
+            exact[i, dim] = table.set_index(dim)
+
+    coverage = {col: [0, 0] for col in MEASURES + ['Transactions', 'Discount', 'Gross PM']}
+    left_out = 0
+    for seed in range(seeds):
+        sample = StratifiedSample.draw(rows, size, seed)
+        for i, selection in enumerate(selections):
+            for dim in aggregates.DIMENSIONS:
+                estimate = sample.group_by(dim, selection).set_index(dim)
+                truth = exact[i, dim]
+                left_out += len(truth.index.difference(estimate.index))
+                truth = truth.loc[estimate.index]
+                for col, counts in coverage.items():
+                    # as rounded for display
+                    slack = {'Gross PM': 0.005, 'Quantity': 0.5, 'Transactions': 0.5}.get(col, 0)
+                    error = (estimate[col] - truth[col]).abs()
+                    counts[0] += int((error <= estimate[col + ' CI'] + slack).sum())
+                    counts[1] += len(estimate)
+    return {col: tuple(counts) for col, counts in coverage.items()}, left_out
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('csv', nargs='?', default='cleaned_df.csv')
+    parser.add_argument('--rows', type=int, default=100000, help='rows to sample (default: 100000)')
+    parser.add_argument('-o', '--out', help='output file (default: <csv>.sample.pkl)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--memory-limit', type=float, default=1024,
+                        help='MiB the CSV blocks may take (default: 1024)')
+    parser.add_argument('--check', action='store_true',
+                        help='report how often the confidence intervals cover the exact values')
+    parser.add_argument('--seeds', type=int, default=20, help='samples drawn by --check (default: 20)')
+    parser.add_argument('--min-coverage', type=float, default=0.9,
+                        help='fail --check below this share of intervals covering (default: 0.9)')
+    args = parser.parse_args(argv)
+
+    if not args.check:
+        print(build(args.csv, args.rows, args.out, args.seed, int(args.memory_limit * 2**20)))
+        return
+    rows = datastore.load(args.csv)
+    coverage, left_out = check(rows, args.rows, args.seeds)
+    print('{:<14} {:>9} {:>9}'.format('column', 'covered', 'coverage'))
+    for col, (covered, n) in coverage.items():
+        print('{:<14} {:>9} {:>9.1%}'.format(col, covered, covered / n))
+    covered, n = map(sum, zip(*coverage.values()))
+    print('{:<14} {:>9} {:>9.1%}   ({} groups left out)'.format('all', covered, covered / n, left_out))
+    return 0 if covered / n >= args.min_coverage else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
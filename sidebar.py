@@ -8,26 +8,134 @@ import pandas as pd
 import numpy as np
 
 import plotly
-import plotly.express as px
 import plotly.graph_objects as go
-from plotly.subplots import make_subplots
+# plotly.express and plotly.subplots are imported where they are used: they
+# are slow to import and not needed until a page or a figure is built
 
 # from jupyter_dash import JupyterDash
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
-from dash.dependencies import Input, Output, State
+from dash.dependencies import Input, Output, State, ClientsideFunction
 import dash_bootstrap_components as dbc
-import locale
+
+import os
+import gzip
+import json
+import time
+import hashlib
+import tempfile
+import functools
+import contextlib
+import threading
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import brotli
+import flask
+
+import datastore
+import aggregates
+import metrics
+import precompute
+import sampling
 
 
 # In[2]:
 
 
 #Initiating data
-df = pd.read_csv('cleaned_df.csv')
-df['Gross PM']=np.multiply(np.divide(df['Profit'],df['Sales']),100).round(2)
-df.head()
+# Loaded from the columnar store built by `python datastore.py` when it is
+# up to date, otherwise parsed from the CSV.
+# With DATA_MODE=aggregates, for data too large to load, no rows are kept:
+# the app starts from the aggregates saved by `python aggregates.py`
+# (built first when stale) and cross-filters with map-reduce passes over
+# the CSV, AGGREGATE_JOBS processes at a time within AGGREGATE_MEMORY bytes.
+DATA_FILE = os.environ.get('DATA_FILE', 'cleaned_df.csv')
+DATA_MODE = os.environ.get('DATA_MODE', 'memory')
+AGGREGATE_JOBS = int(os.environ.get('AGGREGATE_JOBS', 0)) or None
+AGGREGATE_MEMORY = int(os.environ.get('AGGREGATE_MEMORY', 2**30))
+load_started = time.perf_counter()
+if DATA_MODE == 'aggregates':
+    df = None
+    summary = aggregates.load(DATA_FILE, AGGREGATE_JOBS, AGGREGATE_MEMORY)
+else:
+    df = datastore.load(DATA_FILE)
+    summary = None
+    df.head()
+data_load_seconds = time.perf_counter() - load_started
+
+
+# Read-only data access. Callbacks query the shared frame through select()
+# instead of copying it per request. Copy-on-Write makes the frames it hands
+# out lazy copies: nothing is allocated up front, and a write to one can
+# never reach df. (Always on from pandas 3.)
+if int(pd.__version__.split('.')[0]) < 3:
+    pd.set_option('mode.copy_on_write', True)
+
+def select(filters=None):
+    """Rows of the shared frame matching ``{column: value}`` filters."""
+    if not filters:
+        return df.copy(deep=False)
+    if all(col in row_index for col in filters):
+        return df.take(filter_rows(filters))
+    mask = np.ones(len(df), dtype=bool)
+    for col, value in filters.items():
+        mask &= (df[col] == value).to_numpy()
+    return df[mask]
+
+
+# Posting lists for cross-filtering: for every value of each dimension a
+# chart can be filtered on, the sorted row numbers holding it. A selection
+# over several dimensions starts from its shortest list and keeps the rows
+# whose codes match the other dimensions, so its cost depends on the rows
+# selected rather than on the size of the frame; only very broad selections
+# fall back to a pass over the codes.
+FILTER_DIMENSIONS = ['State', 'Region', 'Segment', 'Ship Mode', 'Category', 'Sub-Category']
+
+def build_index(dataframe):
+    index = {}
+    for dim in FILTER_DIMENSIONS:
+        categories = dataframe[dim].cat.categories
+        codes = dataframe[dim].cat.codes.to_numpy()
+        order = np.argsort(codes, kind='stable')
+        bounds = np.searchsorted(codes[order], np.arange(len(categories) + 1))
+        index[dim] = {'categories': categories,
+                      'codes': codes,
+                      'postings': [order[bounds[i]:bounds[i+1]] for i in range(len(categories))]}
+    return index
+
+def filter_rows(selection):
+    """Sorted row numbers matching every ``{dimension: value}`` of ``selection``."""
+    terms = []
+    for dim, value in selection.items():
+        entry = row_index[dim]
+        if value not in entry['categories']:
+            return np.empty(0, dtype=np.intp)
+        code = entry['categories'].get_loc(value)
+        terms.append((len(entry['postings'][code]), dim, code))
+    terms.sort()
+    _, dim, code = terms[0]
+    rows = row_index[dim]['postings'][code]
+    rest = terms[1:]
+    n = len(row_index[dim]['codes'])
+    if not rest or len(rows) * 50 < n * len(rest):
+        for _, dim, code in rest:
+            rows = rows[row_index[dim]['codes'][rows] == code]
+        return rows
+    # A broad selection: a sequential pass over the code arrays is cheaper
+    # than gathering that many scattered rows
+    mask = np.ones(n, dtype=bool)
+    for _, dim, code in terms:
+        mask &= row_index[dim]['codes'] == code
+    return np.flatnonzero(mask)
+
+def without(selection, dim):
+    """``selection`` minus ``dim``: a chart is never filtered by its own
+    dimension, so the other values stay on it to be clicked."""
+    return {k: v for k, v in (selection or {}).items() if k != dim}
+
+row_index = build_index(df) if df is not None else None
 
 
 # ### Creating dash app
@@ -37,38 +145,448 @@ df.head()
 
 # Creating dash app
 
+# compress: Flask-Compress gzips/brotlis every response that isn't already
+# encoded, dynamic callback results included
 app = dash.Dash(__name__, external_stylesheets=[dbc.themes.YETI],
                 suppress_callback_exceptions=True,
+                compress=True,
                meta_tags=[{'name': 'viewport',
                             'content': 'width=device-width, initial-scale=1.0'}]
                )
 server=app.server
 
 
+# ### Callback cache
+
+
+class FigureCache:
+    """Two-tier LRU/TTL cache of serialized callback results.
+
+    The memory tier is private to each worker and capped at ``max_bytes``.
+    The disk tier lives in ``directory`` and is shared by every gunicorn
+    worker on the box, so a figure rendered by one worker is reused by the
+    others. Keys include ``version``, which ties entries to the data and
+    code the process loaded; bumping it invalidates everything cached
+    before.
+    """
+
+    def __init__(self, directory, version, max_bytes=64 * 2**20,
+                 disk_max_bytes=512 * 2**20, ttl=3600):
+        self.directory = directory
+        self.version = version
+        self.max_bytes = max_bytes
+        self.disk_max_bytes = disk_max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._writes = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, name, args):
+        raw = json.dumps([self.version, name, args], sort_keys=True, default=str)
+        return hashlib.sha1(raw.encode()).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                blob, expires = entry
+                if expires > now:
+                    self._entries.move_to_end(key)
+                    return blob
+                self._evict(key)
+        path = os.path.join(self.directory, key + '.json')
+        try:
+            if os.path.getmtime(path) + self.ttl <= now:
+                return None
+            with open(path) as f:
+                blob = f.read()
+        except OSError:
+            return None
+        self._remember(key, blob, now)
+        return blob
+
+    def set(self, key, blob):
+        self._remember(key, blob, time.time())
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            f.write(blob)
+        os.replace(tmp, os.path.join(self.directory, key + '.json'))
+        with self._lock:
+            self._writes += 1
+            prune = self._writes % 32 == 0
+        if prune:
+            self._prune_disk()
+
+    def invalidate(self, version):
+        with self._lock:
+            self.version = version
+            self._entries.clear()
+            self._bytes = 0
+
+    def _remember(self, key, blob, now):
+        with self._lock:
+            if key in self._entries:
+                self._evict(key)
+            self._entries[key] = (blob, now + self.ttl)
+            self._bytes += len(blob)
+            while self._bytes > self.max_bytes and self._entries:
+                self._evict(next(iter(self._entries)))
+
+    def _evict(self, key):
+        blob, _ = self._entries.pop(key)
+        self._bytes -= len(blob)
+
+    def _prune_disk(self):
+        # Oldest first, until both the TTL and the size cap are satisfied.
+        files = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith('.json'):
+                continue
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, entry.path))
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        cutoff = time.time() - self.ttl
+        for mtime, size, path in files:
+            if total <= self.disk_max_bytes and mtime > cutoff:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+# the code and libraries drawing the figures, as precomputed bundles are keyed
+code_version = precompute.code_hash()[:16]
+
+def cache_version(path, ingested=()):
+    """What cached figures were drawn from: the data file, the batches
+    ingested on top of it and the code. A change to any of them is a new
+    version, so another deployment sharing CACHE_DIR can't serve stale
+    figures."""
+    st = os.stat(path)
+    version = '{}:{}:{}:{}'.format(os.path.abspath(path), st.st_mtime_ns, st.st_size, code_version)
+    return '{}+{}'.format(version, ','.join(ingested)) if ingested else version
+
+
+cache = FigureCache(os.environ.get('CACHE_DIR', os.path.join(tempfile.gettempdir(), 'retail-dash-cache')),
+                    version=cache_version(DATA_FILE),
+                    max_bytes=int(os.environ.get('CACHE_MAX_BYTES', 64 * 2**20)),
+                    disk_max_bytes=int(os.environ.get('CACHE_DISK_MAX_BYTES', 512 * 2**20)),
+                    ttl=float(os.environ.get('CACHE_TTL', 3600)))
+
+
+def memoize(name):
+    """Cache a pure callback by ``name`` and its input values."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args):
+            key = cache.key(name, args)
+            blob = cache.get(key)
+            if registry is not None:
+                registry.inc('dash_cache_requests_total', [('cache', name), ('result', 'miss' if blob is None else 'hit')])
+            if blob is None:
+                blob = json.dumps(func(*args), cls=plotly.utils.PlotlyJSONEncoder)
+                cache.set(key, blob)
+            return json.loads(blob)
+
+        def cached(*args):
+            """The cached result, or None."""
+            blob = cache.get(cache.key(name, args))
+            return None if blob is None else json.loads(blob)
+        wrapper.cached = cached
+        return wrapper
+    return decorator
+
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+def single_flight(maxsize=None):
+    """functools.lru_cache for slow functions called from many threads. A
+    hit returns at once without locking. Threads missing the same arguments
+    wait for one of them to compute the result rather than each computing
+    it, while misses on other arguments go ahead. The hit and miss counts
+    are kept without a lock, for metrics, and may drop a few under load."""
+    def decorator(func):
+        entries = OrderedDict()
+        building = {}  # arguments -> lock held while computing them
+        guard = threading.Lock()
+        counts = {'hits': 0, 'misses': 0}
+        missing = object()
+
+        def lookup(args):
+            # OrderedDict's methods are atomic, so a hit needs no lock;
+            # an entry evicted in between is a miss
+            try:
+                entries.move_to_end(args)
+                return entries[args]
+            except KeyError:
+                return missing
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            value = lookup(args)
+            if value is not missing:
+                counts['hits'] += 1
+                return value
+            with guard:
+                lock = building.setdefault(args, threading.Lock())
+            with lock:
+                value = lookup(args)
+                if value is missing:
+                    counts['misses'] += 1
+                    value = func(*args)
+                    with guard:
+                        entries[args] = value
+                        if maxsize is not None and len(entries) > maxsize:
+                            entries.popitem(last=False)
+                        building.pop(args, None)
+                else:
+                    counts['hits'] += 1
+            return value
+
+        def cache_clear():
+            with guard:
+                entries.clear()
+                counts.update(hits=0, misses=0)
+
+        wrapper.cache_info = lambda: CacheInfo(counts['hits'], counts['misses'], maxsize, len(entries))
+        wrapper.cache_clear = cache_clear
+        return wrapper
+    return decorator
+
+
+# ### Callback metrics
+
+
+# METRICS=1 instruments every server-side callback and serves the results
+# in the Prometheus text format on /metrics: calls, latency and response
+# size per callback, result cache hits and misses, the dataset load time
+# and the worker's RSS. With METRICS_DIR set, workers share their numbers
+# through that directory so a scrape of any worker reports all of them.
+# SLOW_CALLBACK_SECONDS logs every callback slower than that, with or
+# without METRICS. With neither set nothing is hooked into the requests.
+METRICS = os.environ.get('METRICS', '0') != '0'
+SLOW_CALLBACK_SECONDS = float(os.environ.get('SLOW_CALLBACK_SECONDS', 0))
+
+registry = None
+if METRICS:
+    registry = metrics.Registry(os.environ.get('METRICS_DIR'))
+    registry.counter('dash_callback_calls_total', 'Callback requests by callback and HTTP status.')
+    registry.histogram('dash_callback_latency_seconds', 'Time to answer a callback request.')
+    registry.histogram('dash_callback_response_bytes', 'Size of callback responses, before Flask-Compress '
+                       '(page routes are served already compressed).', metrics.BYTES_BUCKETS)
+    registry.counter('dash_cache_requests_total', 'Callback result cache lookups by cache and result.')
+    registry.gauge('dash_page_cache_requests', 'Routed page response cache lookups by result.',
+                   lambda: {(('result', 'hit'),): page_response.cache_info().hits,
+                            (('result', 'miss'),): page_response.cache_info().misses})
+    registry.gauge('dash_cache_memory_bytes', 'Bytes held by the in-memory result cache.', lambda: cache._bytes)
+    registry.gauge('dash_data_load_seconds', 'Time taken to load the dataset at startup.', lambda: data_load_seconds)
+    registry.gauge('dash_data_rows', 'Transactions loaded.',
+                   lambda: kpis['Transactions'])
+    registry.gauge('process_resident_memory_bytes', 'Resident memory of the worker.', metrics.rss_bytes)
+
+    @server.route('/metrics')
+    def serve_metrics():
+        return flask.Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+
+def callback_name(output):
+    callback = app.callback_map.get(output, {}).get('callback')
+    return getattr(callback, '__name__', output)
+
+def start_callback_timer():
+    if flask.request.path == app.config.routes_pathname_prefix + '_dash-update-component':
+        flask.g.callback_started = time.perf_counter()
+
+def record_callback(response):
+    started = flask.g.pop('callback_started', None)
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    name = callback_name((flask.request.get_json(silent=True) or {}).get('output', ''))
+    size = response.content_length or 0
+    if registry is not None:
+        registry.inc('dash_callback_calls_total', [('callback', name), ('status', response.status_code)])
+        registry.observe('dash_callback_latency_seconds', elapsed, [('callback', name)])
+        registry.observe('dash_callback_response_bytes', size, [('callback', name)])
+    if SLOW_CALLBACK_SECONDS and elapsed > SLOW_CALLBACK_SECONDS:
+        server.logger.warning('Slow callback %s: %.3fs, %d bytes', name, elapsed, size)
+    return response
+
+if METRICS or SLOW_CALLBACK_SECONDS:
+    # first, so requests answered by another before_request hook (the
+    # routed pages) are timed too
+    server.before_request_funcs.setdefault(None, []).insert(0, start_callback_timer)
+    server.after_request(record_callback)
+
+
 # ### Generating Graphs
 
 # In[4]:
 
 
 def group_by(df,col):
-    grouped = df.groupby(by=col,as_index=False).agg({'Sales':'sum',
-                                                      'Profit':'sum',
-                                                      'Quantity':'sum',
-                                                      'Discount':'mean'
-                                                     })
+    # One pass over the integer codes of the keys (see aggregates.group_sums)
+    # instead of a pandas groupby: only the key combinations present, sorted
+    # like groupby(observed=True).
+    # Transactions counts rows per group in the same pass, so the
+    # 'Transactions' tab plots these instead of shipping raw rows
+    keys = [col] if isinstance(col, str) else list(col)
+    # a key isn't averaged, e.g. Discount in ['Discount','Category']
+    grouped = aggregates.group_sums(df, keys, [m for m in ['Sales','Profit','Quantity','Discount'] if m not in keys])
+    if 'Discount' not in keys:
+        grouped['Discount'] = grouped['Discount'] / grouped['Transactions']
     grouped['Gross PM']=np.multiply(np.divide(grouped['Profit'],grouped['Sales']),100).round(2)
     return grouped
 
 def state_(dataframe):
-    states=dataframe.groupby(['State','state_code','Region'], as_index=False).agg({'Sales':'sum', 
-                                                                        'Profit':'sum', 
-                                                                        'Discount':'mean',
-                                                                        'Quantity':'sum'})
+    states=aggregates.group_sums(dataframe, ['State','state_code','Region'], ['Sales','Profit','Discount','Quantity'])
+    states['Discount'] = states['Discount'] / states['Transactions']
     # Calculating Relative Profit
     states['Gross PM']=np.multiply(np.divide(states['Profit'],states['Sales']),100).round(2)
     states = states.sort_values('Sales',ascending=False,ignore_index=True)
     return states
 
+def _quantile(at, n, p):
+    # Plotly.js's 'linear' quartile method: interpolate at p*n - 0.5 of the
+    # n sorted values, ``at(k)`` being the k-th
+    pos = min(max(p * n - 0.5, 0), n - 1)
+    lo = int(np.floor(pos))
+    hi = int(np.ceil(pos))
+    return at(lo) + (at(hi) - at(lo)) * (pos - lo)
+
+def box_stats(counts, x, y, max_outliers=1000):
+    """Per-``x`` box plot statistics of ``y``, as Plotly would draw them,
+    from the ``[x, y, 'count']`` value counts of aggregates.box_counts.
+
+    Returns one row per ``x`` value with q1, median, q3, the fences (the most
+    extreme points within 1.5 IQR of the box), the mean and the outliers.
+    At most ``max_outliers`` outliers are kept in total, picked evenly across
+    each group's sorted outliers so that its extremes are kept whenever
+    there is room for two per group.
+    """
+    n_outliers = []
+    rows = []
+    for key, group in counts.groupby(x, observed=True):
+        group = group.sort_values(y)
+        values = group[y].to_numpy()
+        weights = group['count'].to_numpy()
+        ends = np.cumsum(weights)
+        at = lambda k: values[np.searchsorted(ends, k, side='right')]
+        q1, median, q3 = (_quantile(at, ends[-1], p) for p in (0.25, 0.5, 0.75))
+        iqr = q3 - q1
+        inside = values[(values >= q1 - 1.5*iqr) & (values <= q3 + 1.5*iqr)]
+        out = (values < inside[0]) | (values > inside[-1])
+        n_outliers.append(weights[out].sum())
+        rows.append({x: key, 'q1': q1, 'median': median, 'q3': q3,
+                     'lowerfence': inside[0], 'upperfence': inside[-1],
+                     'mean': (values * weights).sum() / ends[-1], 'outliers': (values[out], weights[out])})
+    n_outliers = np.array(n_outliers, dtype=int)
+    keeps = n_outliers
+    if n_outliers.sum() > max_outliers:
+        # shares of max_outliers in proportion, by largest remainder so they
+        # add up to it exactly, after the two extremes of every group if
+        # there is room for them
+        floor = np.minimum(n_outliers, 2)
+        if floor.sum() > max_outliers:
+            floor = np.zeros_like(n_outliers)
+        share = floor + (max_outliers - floor.sum()) * (n_outliers - floor) / (n_outliers - floor).sum()
+        keeps = np.floor(share).astype(int)
+        keeps[np.argsort(keeps - share, kind='stable')[:max_outliers - keeps.sum()]] += 1
+    for row, n, keep in zip(rows, n_outliers, keeps):
+        values, weights = row['outliers']
+        if keep < n:
+            picks = np.linspace(0, n - 1, keep).round().astype(int)
+            row['outliers'] = values[np.searchsorted(np.cumsum(weights), picks, side='right')]
+        else:
+            row['outliers'] = np.repeat(values, weights)
+    return pd.DataFrame(rows, columns=[x, 'q1', 'median', 'q3', 'lowerfence', 'upperfence', 'mean', 'outliers'])
+
+
+# Aggregate cube: every dimension the home page plots, grouped once at load.
+# Callbacks only slice it instead of regrouping the raw rows per request.
+DIMENSIONS = ['Ship Mode', 'Segment', 'Region', 'Category']
+
+def build_cube(dataframe):
+    cube = {dim: group_by(dataframe, dim) for dim in DIMENSIONS}
+    cube['State'] = state_(dataframe)
+    return cube
+
+cube = build_cube(df) if summary is None else summary['cube']
+
+
+# Discount tensor for the page-1 bars. Discount is quantized to integer
+# bucket codes and the additive metrics are summed into dense arrays indexed
+# by (sub-category or category, discount bucket, metric), so every dropdown
+# and tab combination is a slice instead of a scan and a hash groupby.
+TENSOR_METRICS = ['Sales', 'Profit', 'Quantity', 'Transactions']
+
+def build_discount_tensor(dataframe):
+    levels, buckets = np.unique(dataframe['Discount'].to_numpy(), return_inverse=True)
+    # rows are counted, unless they are already aggregates carrying counts
+    weights = [dataframe['Sales'], dataframe['Profit'], dataframe['Quantity'], dataframe.get('Transactions')]
+    tensor = {'levels': levels}
+    for dim in ['Sub-Category', 'Category']:
+        categories = dataframe[dim].cat.categories
+        cells = len(categories) * len(levels)
+        flat = dataframe[dim].cat.codes.to_numpy().astype(np.intp) * len(levels) + buckets
+        sums = np.stack([np.bincount(flat, weights=w, minlength=cells) for w in weights], axis=-1)
+        tensor[dim] = (categories, sums.reshape(len(categories), len(levels), len(TENSOR_METRICS)))
+    return tensor
+
+def discount_frame(product=None, tensor=None):
+    """group_by on Discount for one sub-category, or on Discount and
+    Category for every category when ``product`` is None."""
+    tensor = discount_tensor if tensor is None else tensor
+    levels = tensor['levels']
+    if product is None:
+        categories, sums = tensor['Category']
+        # discount-major, like a groupby on ['Discount','Category']
+        sums = sums.transpose(1, 0, 2)
+        keys = {'Discount': np.repeat(levels, len(categories)),
+                'Category': pd.Categorical.from_codes(np.tile(np.arange(len(categories)), len(levels)), categories)}
+    else:
+        categories, sums = tensor['Sub-Category']
+        sums = sums[categories.get_loc(product)][np.newaxis]
+        keys = {'Discount': levels}
+    sums = sums.reshape(-1, len(TENSOR_METRICS))
+    present = sums[:, 3] > 0
+    frame = pd.DataFrame({k: v[present] for k, v in keys.items()})
+    frame['Sales'] = sums[present, 0]
+    frame['Profit'] = sums[present, 1]
+    frame['Quantity'] = sums[present, 2].astype(np.int64)
+    frame['Transactions'] = sums[present, 3].astype(np.int64)
+    frame['Gross PM']=np.multiply(np.divide(frame['Profit'],frame['Sales']),100).round(2)
+    return frame
+
+discount_tensor = build_discount_tensor(df if summary is None else summary['discount'])
+
+# Headline KPIs of the home and conclusion pages, from per-discount-level
+# sums taken in one pass over the rows. The sums are additive, so an
+# ingested batch's are merged in and the KPIs derived again from a few rows.
+kpi_table = aggregates.kpi_sums(df) if summary is None else summary['kpi']
+kpis = aggregates.kpis(kpi_table)
+
+# Stratified sample of about SAMPLE_ROWS rows (see sampling.py) that
+# cross-filter selections are first answered from, while the exact answer
+# is computed; unset, every answer is exact. Without rows it is drawn in a
+# pass over the CSV and saved next to it.
+SAMPLE_ROWS = int(os.environ.get('SAMPLE_ROWS', 0))
+if not SAMPLE_ROWS:
+    sample = None
+elif df is not None:
+    sample = sampling.StratifiedSample.draw(df, SAMPLE_ROWS)
+else:
+    sample = sampling.load(DATA_FILE, SAMPLE_ROWS, memory_limit=AGGREGATE_MEMORY)
+
 
 # In[5]:
 
@@ -81,73 +599,109 @@ global_font=dict(family="Balto")
 # In[6]:
 
 
-states=state_(df)
-us_map=px.choropleth(data_frame=states,
-                    locationmode ='USA-states',
-                    locations='state_code',
-                    scope='usa',
-                    color='Gross PM',color_continuous_scale='blues_r',color_continuous_midpoint=0,
-                    hover_name='State',
-                    hover_data={'State':False,'Sales':True,'Discount':True,'state_code':False, 'Region':True},
-                    labels={'Gross PM':'Gross Profit Margin','Discount_mean':'Avg. Discount'},)
+states=cube['State']
 
-us_map.update_layout(title={'text':'Gross Profit Margin - USA Map', 
-                            'font':title_font,
-                            'x':0.5, 'y':0.9,
-                            'xanchor':'center', 'yanchor':'middle'},
-                     font=global_font,
-                     font_color='black',
-                     geo=dict(bgcolor='rgba(0,0,0,0)'),
-                     paper_bgcolor='rgba(0,0,0,0)',plot_bgcolor='rgba(0,0,0,0)')
+# Static figures are built on first use by the page that shows them
+def map_figure(data=None):
+    import plotly.express as px
+    
+    data = states if data is None else data
+    hover_data = {'State':False,'Sales':True,'Discount':True,'state_code':False, 'Region':True}
+    estimate = 'Sales CI' in data.columns
+    if estimate:
+        hover_data.update({'Sales CI':':,.2f', 'Gross PM CI':':.2f'})
+    us_map=px.choropleth(data_frame=data,
+                        locationmode ='USA-states',
+                        locations='state_code',
+                        scope='usa',
+                        color='Gross PM',color_continuous_scale='blues_r',color_continuous_midpoint=0,
+                        hover_name='State',
+                        hover_data=hover_data,
+                        labels={'Gross PM':'Gross Profit Margin','Discount_mean':'Avg. Discount',
+                                'Sales CI':'Sales ± (95% CI)', 'Gross PM CI':'Gross PM ± (95% CI)'},)
+
+    us_map.update_layout(title={'text':'Gross Profit Margin - USA Map', 
+                                'font':title_font,
+                                'x':0.5, 'y':0.9,
+                                'xanchor':'center', 'yanchor':'middle'},
+                         font=global_font,
+                         font_color='black',
+                         geo=dict(bgcolor='rgba(0,0,0,0)'),
+                         paper_bgcolor='rgba(0,0,0,0)',plot_bgcolor='rgba(0,0,0,0)')
+    if estimate:
+        us_map.add_annotation(ESTIMATE_NOTE)
+    return us_map
 
 
 # In[7]:
 
 
-# BoxPlot Discount vs gross profit margin
-fig_1 = px.box(df, x='Discount', y='Gross PM',
-               title='Gross Profit Margin Behaviour Under Range of Discounts',
-               labels={'Discount':'Product Discount',
-                       'Gross PM':'Gross Profit Margin'}
-              ).update_traces(marker={'color':'#3399CC'}
-                             ).update_layout(height=500, width=900,
-                                             title={'font':title_font,
-                                                    'x':0.5, 'y':0.9,
-                                                    'xanchor':'center', 'yanchor':'middle'},
-                                             font=global_font,
-                                             legend={'font':legend_font}, 
-                                             font_color='black',
-                                             plot_bgcolor='rgba(0,0,0,0)',paper_bgcolor='rgba(0,0,0,0)')
-fig_1.add_hline(y=0, line_dash="dot",
-              annotation_text="Zero Profit", 
-              annotation_position="bottom right")
-fig_1.add_vrect(x0=0.35, x1=0.45, 
-              annotation_text="Decline", annotation_position="top left",
-              fillcolor='red', opacity=0.20, line_width=0)
-fig_1.add_vline(x=0.41, line_width=1, line_dash="dash", line_color="red")
+# BoxPlot Discount vs gross profit margin. The box statistics are computed
+# here rather than by Plotly.js from every transaction, so the payload stays
+# the same size however many rows there are.
+def box_figure(counts=None):
+    if counts is None:
+        counts = aggregates.box_counts(df) if summary is None else summary['box']
+    discount_box = box_stats(counts, 'Discount', 'Gross PM',
+                             max_outliers=int(os.environ.get('BOX_MAX_OUTLIERS', 1000)))
+    box_outliers = discount_box.explode('outliers').dropna(subset=['outliers'])
+    fig_1 = go.Figure(
+        [go.Box(x=discount_box['Discount'], q1=discount_box['q1'], median=discount_box['median'], q3=discount_box['q3'],
+                lowerfence=discount_box['lowerfence'], upperfence=discount_box['upperfence'], mean=discount_box['mean'],
+                boxmean=False, boxpoints=False, name='', showlegend=False, marker={'color':'#3399CC'}),
+         go.Scatter(x=box_outliers['Discount'], y=box_outliers['outliers'].astype(float),
+                    mode='markers', name='', showlegend=False, marker={'color':'#3399CC'},
+                    hovertemplate='Product Discount=%{x}<br>Gross Profit Margin=%{y}<extra></extra>')],
+        layout={'title':{'text':'Gross Profit Margin Behaviour Under Range of Discounts'},
+                'xaxis':{'title':{'text':'Product Discount'}},
+                'yaxis':{'title':{'text':'Gross Profit Margin'}},
+                'legend':{'tracegroupgap':0}, 'margin':{'t':60}, 'boxmode':'group'}
+    ).update_layout(height=500, width=900,
+                    title={'font':title_font,
+                           'x':0.5, 'y':0.9,
+                           'xanchor':'center', 'yanchor':'middle'},
+                    font=global_font,
+                    legend={'font':legend_font}, 
+                    font_color='black',
+                    plot_bgcolor='rgba(0,0,0,0)',paper_bgcolor='rgba(0,0,0,0)')
+    fig_1.add_hline(y=0, line_dash="dot",
+                  annotation_text="Zero Profit", 
+                  annotation_position="bottom right")
+    fig_1.add_vrect(x0=0.35, x1=0.45, 
+                  annotation_text="Decline", annotation_position="top left",
+                  fillcolor='red', opacity=0.20, line_width=0)
+    fig_1.add_vline(x=0.41, line_width=1, line_dash="dash", line_color="red")
+    return fig_1
 
 
 # In[8]:
 
 
-# Sunburst Plot
-fig_2 = px.sunburst(data_frame=df, 
-                    path = ['Category','Sub-Category'],
-                    values='Quantity',
-                    color='Profit',
-                    color_continuous_scale='blues',
-                    hover_data={'Quantity':True,'Profit':True},)
-fig_2.update_traces(textfont={'family':'arial'},
-                    textinfo='label+percent entry',
-                    insidetextorientation='radial',
-                    marker={'line':{'color':'black'}})   
-fig_2.update_layout(title={'text':'Quantity sold and profit gained for each product type',
-                           'font':title_font,
-                           'x':0.5, 'y':0.02,
-                           'xanchor':'center', 'yanchor':'bottom'},
-                    legend={'font':legend_font}, font_color='black',
-                    font=global_font,
-                    plot_bgcolor='rgba(0,0,0,0)',paper_bgcolor='rgba(0,0,0,0)')
+# Sunburst Plot, drawn from one row per sub-category rather than every
+# transaction
+def sunburst_figure(leaves=None):
+    import plotly.express as px
+    
+    if leaves is None:
+        leaves = aggregates.sunburst_leaves(aggregates.sunburst_sums(df)) if summary is None else summary['sunburst']
+    fig_2 = px.sunburst(data_frame=leaves, 
+                        path = ['Category','Sub-Category'],
+                        values='Quantity',
+                        color='Profit',
+                        color_continuous_scale='blues',
+                        hover_data={'Quantity':True,'Profit':True},)
+    fig_2.update_traces(textfont={'family':'arial'},
+                        textinfo='label+percent entry',
+                        insidetextorientation='radial',
+                        marker={'line':{'color':'black'}})   
+    fig_2.update_layout(title={'text':'Quantity sold and profit gained for each product type',
+                               'font':title_font,
+                               'x':0.5, 'y':0.02,
+                               'xanchor':'center', 'yanchor':'bottom'},
+                        legend={'font':legend_font}, font_color='black',
+                        font=global_font,
+                        plot_bgcolor='rgba(0,0,0,0)',paper_bgcolor='rgba(0,0,0,0)')
+    return fig_2
 
 
 # ### Side Bar
@@ -207,97 +761,109 @@ tab_selected_style = {
     'margin':'0.5rem'
 }
 
-# to format thousands commas in numbers
-locale.setlocale(locale.LC_ALL, '')
-
 
 # In[11]:
 
 
-h_container = dbc.Container(
-    [        
-        dbc.Row(
-            [
-                dbc.Col(
-                    dcc.Tabs(id="radio_options",
-                             value='Transactions',
-                             children=[dcc.Tab(label='Total Transactions',
-                                               value='Transactions',
-                                               style=tab_style, selected_style=tab_selected_style,
-#                                                selected_className='bg-dark text-white',
-                                              ),
-                                       dcc.Tab(label='Sales',
-                                               value='Sales',
-                                               style=tab_style, selected_style=tab_selected_style,
-#                                                selected_className='bg-dark text-white',
-                                              ),
-                                       dcc.Tab(label='Profit',
-                                               value='Profit', 
-                                               style=tab_style, selected_style=tab_selected_style,
-#                                                selected_className='bg-dark text-white',
-                                              ),
-                                       dcc.Tab(label='Quantity',
-                                               value='Quantity',
-                                               style=tab_style, selected_style=tab_selected_style,
-#                                                selected_className='bg-dark text-white',
-                                              ),
-                                       dcc.Tab(label='Average Discount',
-                                               value='Discount',
-                                               style=tab_style, selected_style=tab_selected_style,
-#                                                selected_className='bg-dark text-white',
-                                              ),
-                                      ],
-                            )
-                )
-            ],no_gutters=True, justify = 'around',
-        ),       
+# Page layouts are built the first time render_page_content routes to them
+# and cached from then on, so a worker only pays for the pages it serves.
+@functools.lru_cache(maxsize=None)
+def home_page():
+    h_container = dbc.Container(
+        [        
+            dcc.Store(id='home-aggregates', data=home_store()),
+            # polls for the exact figures while estimates are shown
+            dcc.Interval(id='home-exact', interval=500, disabled=True),
+            
+            dbc.Row(
+                [
+                    dbc.Col(
+                        dcc.Tabs(id="radio_options",
+                                 value='Transactions',
+                                 children=[dcc.Tab(label='Total Transactions',
+                                                   value='Transactions',
+                                                   style=tab_style, selected_style=tab_selected_style,
+    #                                                selected_className='bg-dark text-white',
+                                                  ),
+                                           dcc.Tab(label='Sales',
+                                                   value='Sales',
+                                                   style=tab_style, selected_style=tab_selected_style,
+    #                                                selected_className='bg-dark text-white',
+                                                  ),
+                                           dcc.Tab(label='Profit',
+                                                   value='Profit', 
+                                                   style=tab_style, selected_style=tab_selected_style,
+    #                                                selected_className='bg-dark text-white',
+                                                  ),
+                                           dcc.Tab(label='Quantity',
+                                                   value='Quantity',
+                                                   style=tab_style, selected_style=tab_selected_style,
+    #                                                selected_className='bg-dark text-white',
+                                                  ),
+                                           dcc.Tab(label='Average Discount',
+                                                   value='Discount',
+                                                   style=tab_style, selected_style=tab_selected_style,
+    #                                                selected_className='bg-dark text-white',
+                                                  ),
+                                          ],
+                                )
+                    )
+                ],no_gutters=True, justify = 'around',
+            ),       
         
-        dbc.Row(
-            [     
-                dbc.Col(
-                    [
-                        html.P('Total Sales', 
-                                style={
-                                       'margin':'1rem', 
-                                       'textAlign':'center',
-                                      'border':'1px solid white'},
-                                className='text-white rounded-lg shadow p-1 bg-dark',
-                               ),
-                        html.P('USD {}'.format(str(locale.format("%.4f", df.Sales.sum().round(2), grouping=True))),
-                                style={'textAlign':'center','fontColor':'black'}),
+            dbc.Row(
+                [     
+                    dbc.Col(
+                        [
+                            html.P('Total Sales', 
+                                    style={
+                                           'margin':'1rem', 
+                                           'textAlign':'center',
+                                          'border':'1px solid white'},
+                                    className='text-white rounded-lg shadow p-1 bg-dark',
+                                   ),
+                            html.P('USD {:,.4f}'.format(round(kpis['Sales'], 2)),
+                                    style={'textAlign':'center','fontColor':'black'}),
                         
-                        html.P('Total Profit', 
-                                style={
-                                       'margin':'1rem', 
-                                       'textAlign':'center',
-                                      'border':'1px solid white'},
-                                className='text-white rounded-lg shadow p-1 bg-dark',
-                               ),
-                        html.P('USD {}'.format(str(locale.format("%.4f", df.Profit.sum().round(2), grouping=True))),
-                                style={'textAlign':'center','color':'black'}),
+                            html.P('Total Profit', 
+                                    style={
+                                           'margin':'1rem', 
+                                           'textAlign':'center',
+                                          'border':'1px solid white'},
+                                    className='text-white rounded-lg shadow p-1 bg-dark',
+                                   ),
+                            html.P('USD {:,.4f}'.format(round(kpis['Profit'], 2)),
+                                    style={'textAlign':'center','color':'black'}),
+                            
+                            html.P(id='selection-label',
+                                   style={'textAlign':'center', 'fontSize':12, 'margin':'1rem 0.5rem 0.5rem'}),
+                            dbc.Button('Clear selection', id='clear-selection',
+                                       size='sm', color='dark', outline=True,
+                                       style={'display':'block', 'margin':'0 auto 1rem'}),
                         
-                    ],width=2, style={"border": "2px solid black", 'borderRight':False},
-                ),
+                        ],width=2, style={"border": "2px solid black", 'borderRight':False},
+                    ),
                 
-                dbc.Col(
-                    [
-                        dcc.Graph(id='subplot',figure={})
-                    ],width={'size':5, 'offset':0}, style={"border": "2px solid black"},
-                ),
+                    dbc.Col(
+                        [
+                            dcc.Graph(id='subplot',figure={})
+                        ],width={'size':5, 'offset':0}, style={"border": "2px solid black"},
+                    ),
                 
-                dbc.Col(
-                    [
-                        dcc.Graph(id='map',figure=us_map)
-                    ],width={'size':5, 'offset':0},style={"border": "2px solid black", 'borderLeft':False})
-            ],no_gutters=True, justify = 'around',
-        ), 
+                    dbc.Col(
+                        [
+                            dcc.Graph(id='map',figure=map_figure())
+                        ],width={'size':5, 'offset':0},style={"border": "2px solid black", 'borderLeft':False})
+                ],no_gutters=True, justify = 'around',
+            ), 
         
-        dbc.Row([
-            dbc.Col(dcc.Graph(id='bar',figure={}),
-                   style={"border": "2px solid black", 'borderTop':False})
-        ],no_gutters=True, justify = 'around',),
-    ], fluid=True,
-)
+            dbc.Row([
+                dbc.Col(dcc.Graph(id='bar',figure={}),
+                       style={"border": "2px solid black", 'borderTop':False})
+            ],no_gutters=True, justify = 'around',),
+        ], fluid=True,
+    )
+    return h_container
 
 
 # ### Page-1 Layout
@@ -306,14 +872,14 @@ h_container = dbc.Container(
 
 
 # Tab style
-tab_style = {
+p1_tab_style = {
     'border': '1px solid black',
     'padding': '6px',
     'margin':'1rem',
     'fontWeight': 'bold',
 }
 
-tab_selected_style = {
+p1_tab_selected_style = {
     'border':'1px solid white' ,
     'background-color': '#3399CC',
     'color':'white',
@@ -321,67 +887,74 @@ tab_selected_style = {
     'padding': '6px'
 }
 
-dropdown = dcc.Dropdown(id='product-dropdown',
-                        options=[{'label': x, 'value': x} for x in sorted(df['Sub-Category'].unique())],
-                        placeholder="Select a product",
-                        style={'margin':'1rem',}
-                       )
-
-options = dcc.Tabs(id="tabs",
-                   value="Profit",
-                   children=[dcc.Tab(label="Profit", value="Profit",
-                                     style=tab_style,selected_style=tab_selected_style),
-                             dcc.Tab(label="Quantity", value="Quantity",
-                                     style=tab_style,selected_style=tab_selected_style)],
-                             vertical=False,
-                  )
-p1_container = dbc.Container(
-    [
-        dbc.Row(
-            [
-                dbc.Col([
+
+@functools.lru_cache(maxsize=None)
+def profit_page():
+    dropdown = dcc.Dropdown(id='product-dropdown',
+                            options=[{'label': x, 'value': x} for x in sorted(discount_tensor['Sub-Category'][0])],
+                            placeholder="Select a product",
+                            style={'margin':'1rem',}
+                           )
+
+    options = dcc.Tabs(id="tabs",
+                       value="Profit",
+                       children=[dcc.Tab(label="Profit", value="Profit",
+                                         style=p1_tab_style,selected_style=p1_tab_selected_style),
+                                 dcc.Tab(label="Quantity", value="Quantity",
+                                         style=p1_tab_style,selected_style=p1_tab_selected_style)],
+                                 vertical=False,
+                      )
+    p1_container = dbc.Container(
+        [
+            dbc.Row(
+                [
+                    dbc.Col([
                     
-                    dbc.Row(
-                        [
-                            dbc.Col(dropdown, width=6),
-                            dbc.Col(options, width=6),
-                        ],
-                    ),
+                        html.P(id='selection-note', style={'margin':'1rem 1rem 0', 'fontSize':12}),
+                        
+                        dbc.Row(
+                            [
+                                dbc.Col(dropdown, width=6),
+                                dbc.Col(options, width=6),
+                            ],
+                        ),
                     
-                    dcc.Graph(id='heat',figure={}),
+                        dcc.Graph(id='heat',figure={}),
+                        dcc.Interval(id='heat-exact', interval=500, disabled=True),
                     
-                ], width={'size':7},style={"border": "1px solid black",}),
+                    ], width={'size':7},style={"border": "1px solid black",}),
                 
-                dbc.Col(
-                    dcc.Graph(id='sunburst',figure=fig_2, responsive=True),
-                    width={'size':5},style={"border": "1px solid black",},
-                ),
-            ],no_gutters=True,justify = 'around',
-        ),
+                    dbc.Col(
+                        dcc.Graph(id='sunburst',figure=sunburst_figure(), responsive=True),
+                        width={'size':5},style={"border": "1px solid black",},
+                    ),
+                ],no_gutters=True,justify = 'around',
+            ),
         
-        dbc.Row(
-            [
-                dbc.Col(dcc.Graph(id='box',figure=fig_1),),
-                dbc.Col(
-                    dbc.Card(
-                        [
-                            dbc.CardBody(
-                                [
-                                    html.P(
-                                        ['There is a progressive decline in the profit margin as discount increases.',
-                                         html.Hr(),
-                                        'Red region denotes the transition of all transactions to negative profit margin.',],
-                                        className="card-text",),
-                                ],),
-                        ],color='red',style={'background-color':'rgba(255, 0, 0, 0.2)', 'font-color':'black'},
+            dbc.Row(
+                [
+                    dbc.Col(dcc.Graph(id='box',figure=box_figure()),),
+                    dbc.Col(
+                        dbc.Card(
+                            [
+                                dbc.CardBody(
+                                    [
+                                        html.P(
+                                            ['There is a progressive decline in the profit margin as discount increases.',
+                                             html.Hr(),
+                                            'Red region denotes the transition of all transactions to negative profit margin.',],
+                                            className="card-text",),
+                                    ],),
+                            ],color='red',style={'background-color':'rgba(255, 0, 0, 0.2)', 'font-color':'black'},
+                        ),
+                        className='d-flex justify-content-center align-items-center',
+                        style={'margin':'1rem'},
                     ),
-                    className='d-flex justify-content-center align-items-center',
-                    style={'margin':'1rem'},
-                ),
-            ], no_gutters=True,justify = 'around',
-        ),
-    ],fluid=True,
-)
+                ], no_gutters=True,justify = 'around',
+            ),
+        ],fluid=True,
+    )
+    return p1_container
 
 
 # ### Conclusion Layout
@@ -389,90 +962,96 @@ p1_container = dbc.Container(
 # In[13]:
 
 
-# Creating card components
+@functools.lru_cache(maxsize=None)
+def conclusion_page():
+    # Creating card components
 
-card_main = dbc.Card(
-    [
-        dbc.CardHeader(html.H4("Initial Insights", className="card-title"),
-                       className='bg-primary text-white',
-                      ),
-        dbc.CardBody(
-            [         
-                dbc.ListGroup(
-                    [
-                        dbc.ListGroupItem("1. Total 9977 customer transactions"),
-                        dbc.ListGroupItem("2. An average sales of USD 230.14 per customer transaction"),
-                        dbc.ListGroupItem("3. An average profit of USD 28.69 per customer transaction"),
-                    ],
-                ),
-            ], className='bg-info',
-        ),
-    ],
-)
+    card_main = dbc.Card(
+        [
+            dbc.CardHeader(html.H4("Initial Insights", className="card-title"),
+                           className='bg-primary text-white',
+                          ),
+            dbc.CardBody(
+                [         
+                    dbc.ListGroup(
+                        [
+                            dbc.ListGroupItem("1. Total {:,} customer transactions".format(kpis['Transactions'])),
+                            dbc.ListGroupItem("2. An average sales of USD {:.2f} per customer transaction".format(kpis['Average Sales'])),
+                            dbc.ListGroupItem("3. An average profit of USD {:.2f} per customer transaction".format(kpis['Average Profit'])),
+                            dbc.ListGroupItem("4. Transactions at a loss by discount: " +
+                                              ", ".join("{} {:.0%}".format(band['Band'].lower(), band['Loss Share'])
+                                                        for band in kpis['Bands'])),
+                        ],
+                    ),
+                ], className='bg-info',
+            ),
+        ],
+    )
 
 
 
-card_con = dbc.Card(
-    [
-        dbc.CardHeader(html.H4("Weak Areas", className="card-title"),
-                      className='bg-primary text-white',),
-        dbc.CardBody(
-            [
-                dbc.ListGroup(
-                    [
-                        dbc.ListGroupItem("1. Gross profit margin seem to be less for higher discount on products."),
-                        dbc.ListGroupItem("2. Beyond 40% discount, the store has experienced loss only"),
-                        dbc.ListGroupItem("3. The quantities sold are not higher for increased discount."),
-                    ],
-                ),
-            ],className='bg-info',
-        ),
-    ],
-)
+    card_con = dbc.Card(
+        [
+            dbc.CardHeader(html.H4("Weak Areas", className="card-title"),
+                          className='bg-primary text-white',),
+            dbc.CardBody(
+                [
+                    dbc.ListGroup(
+                        [
+                            dbc.ListGroupItem("1. Gross profit margin seem to be less for higher discount on products."),
+                            dbc.ListGroupItem("2. Beyond 40% discount, the store has experienced loss only"),
+                            dbc.ListGroupItem("3. The quantities sold are not higher for increased discount."),
+                        ],
+                    ),
+                ],className='bg-info',
+            ),
+        ],
+    )
 
-card_final = dbc.Card(
-    [
-        dbc.CardHeader(html.H4("Conclusion", className="card-title"),
-                      className='bg-primary text-white',),
-        dbc.CardBody(
-            [
-                html.P([
-                    "The store has performed well when no discount or less than 20% discount is applied",
-                    html.Hr(), 
-                    'The store might benefit by reducing discount on loss making product items.',
-                    html.Hr(),
-                    'Marketing and advertisement in regions with less customer base might help to increase the store presence.',               
-                ],
-                    className="card-text",
-                ),
-            ],className='bg-info',
-        ),
+    card_final = dbc.Card(
+        [
+            dbc.CardHeader(html.H4("Conclusion", className="card-title"),
+                          className='bg-primary text-white',),
+            dbc.CardBody(
+                [
+                    html.P([
+                        "The store has performed well when no discount or less than 20% discount is applied",
+                        html.Hr(), 
+                        'The store might benefit by reducing discount on loss making product items.',
+                        html.Hr(),
+                        'Marketing and advertisement in regions with less customer base might help to increase the store presence.',               
+                    ],
+                        className="card-text",
+                    ),
+                ],className='bg-info',
+            ),
         
-        dbc.CardLink("GitHub Link", 
-                     className='text-center font-weight-bold',
-                     href="https://github.com/sayaliba01/The-Sparks-Foundation-GRIPJAN21/tree/main/EDA-Retail%20Data")
-    ],
-    color='primary',
-    outline=True,
-)
+            dbc.CardLink("GitHub Link", 
+                         className='text-center font-weight-bold',
+                         href="https://github.com/sayaliba01/The-Sparks-Foundation-GRIPJAN21/tree/main/EDA-Retail%20Data")
+        ],
+        color='primary',
+        outline=True,
+    )
 
-# Conclusion page container
-p2_container=dbc.Container(
-    [
-        dbc.Row(
-            [
-                dbc.Col(card_main, width={'size':4,'offset':1}, style={'marginTop':'2rem'}),
-                dbc.Col(card_con, width={'size':4,'offset':1}, style={'marginTop':'2rem'}),
-            ], no_gutters=True,justify="around"
-        ),
+    # Conclusion page container
+    p2_container=dbc.Container(
+        [
+            dbc.Row(
+                [
+                    dbc.Col(card_main, width={'size':4,'offset':1}, style={'marginTop':'2rem'}),
+                    dbc.Col(card_con, width={'size':4,'offset':1}, style={'marginTop':'2rem'}),
+                ], no_gutters=True,justify="around"
+            ),
         
-        dbc.Row(
-            [
-                dbc.Col(card_final, width={'size':6}, style={'marginTop':'2rem', 'marginBottom':'2rem'}),
-            ], no_gutters=True,justify="around"
-        ),
-    ]
-)
+            dbc.Row(
+                [
+                    dbc.Col(card_final, width={'size':6}, style={'marginTop':'2rem', 'marginBottom':'2rem'}),
+                ], no_gutters=True,justify="around"
+            ),
+        ]
+    )
+    return p2_container
 
 
 # ### Main content Layout
@@ -500,6 +1079,9 @@ content = html.Div(id="page-content", children=[],
 app.layout = html.Div(
     [
         dcc.Location(id="url"),
+        # {dimension: value} picked by clicking the home-page charts; every
+        # home and page-1 chart is filtered to it
+        dcc.Store(id='selection', data={}),
         sidebar,
         content
     ]
@@ -513,22 +1095,19 @@ app.layout = html.Div(
 # In[16]:
 
 
+PAGES = {'/': home_page,
+         '/page-1': profit_page,
+         '/page-2': conclusion_page}
+
+
 @app.callback(
     Output("page-content", "children"),
     [Input("url", "pathname")]
 )
 def render_page_content(pathname):
-    if pathname == "/":
-        return [
-                h_container
-                ]
-    elif pathname == "/page-1":
+    if pathname in PAGES:
         return [
-                p1_container,
-                ]
-    elif pathname == "/page-2":
-        return [
-                p2_container,
+                PAGES[pathname](),
                 ]
     # If the user tries to reach a different page, return a 404 message
     return dbc.Jumbotron(
@@ -540,58 +1119,171 @@ def render_page_content(pathname):
     )
 
 
+# The routed pages never change, so their render_page_content responses are
+# serialized once, compressed ahead of time and served straight from bytes,
+# with an ETag per encoding so clients can revalidate with If-None-Match.
+def compressed(body):
+    return {'etag': hashlib.sha1(body).hexdigest(),
+            'identity': body,
+            'gzip': gzip.compress(body, 9),
+            'br': brotli.compress(body, quality=11)}
+
+@single_flight(maxsize=None)
+def page_response(pathname):
+    body = json.dumps({'response': {'page-content': {'children': [PAGES[pathname]()]}},
+                       'multi': True},
+                      cls=plotly.utils.PlotlyJSONEncoder).encode()
+    return compressed(body)
+
+def send_compressed(blobs):
+    request = flask.request
+    encoding = request.accept_encodings.best_match(['br', 'gzip'], default='identity')
+    etag = '{}-{}'.format(blobs['etag'], encoding)
+    if etag in request.if_none_match:
+        response = flask.Response(status=304)
+    else:
+        response = flask.Response(blobs[encoding], mimetype='application/json')
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+    response.set_etag(etag)
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+# Responses built ahead of time by `python precompute.py` for every input
+# combination of the pages, heat and the selection callbacks, loaded when
+# PRECOMPUTED_DIR has a bundle built from this data and this code. Requests
+# found in it are answered by lookup; the rest fall through to the
+# callbacks. An ingested batch changes the data, so it drops the bundle.
+PRECOMPUTED_DIR = os.environ.get('PRECOMPUTED_DIR', 'precomputed')
+bundle = precompute.load(PRECOMPUTED_DIR, DATA_FILE) if PRECOMPUTED_DIR else None
+
+
+def update_request():
+    request = flask.request
+    if request.path != app.config.routes_pathname_prefix + '_dash-update-component':
+        return None
+    return request.get_json(silent=True) or {}
+
+@server.before_request
+def serve_precomputed():
+    entries = bundle
+    if entries is None:
+        return None
+    payload = update_request()
+    if payload is None:
+        return None
+    blobs = entries.get(precompute.request_key(payload))
+    if registry is not None:
+        registry.inc('dash_cache_requests_total', [('cache', 'precomputed'),
+                                                   ('result', 'miss' if blobs is None else 'hit')])
+    return send_compressed(blobs) if blobs is not None else None
+
+@server.before_request
+def serve_page_response():
+    payload = update_request()
+    if payload is None or payload.get('output') != 'page-content.children':
+        return None
+    pathname = payload['inputs'][0].get('value')
+    if pathname not in PAGES:
+        return None
+    return send_compressed(page_response(pathname))
+
+
+# __Figure skeletons__
+
+# Plotly Express and make_subplots validate every property and reprocess the
+# dataframe on each call, which dominates the cost of these small figures.
+# Each chart variant is built that way once and kept as a plain-dict
+# skeleton; callbacks only swap in their data arrays.
+def skeleton(fig):
+    fig = fig.to_plotly_json()
+    return {'data': fig['data'], 'layout': fig['layout']}
+
+def fill(skeleton, traces):
+    """``skeleton`` with each trace updated from the matching dict of
+    ``traces``, merging nested dicts one level deep; None drops the trace."""
+    data = []
+    for trace, arrays in zip(skeleton['data'], traces):
+        if arrays is None:
+            continue
+        trace = dict(trace)
+        for key, value in arrays.items():
+            trace[key] = dict(trace[key], **value) if isinstance(value, dict) else value
+        data.append(trace)
+    return {'data': data, 'layout': skeleton['layout']}
+
+
+# Approximate answers. With a sample, a selection whose exact result isn't
+# cached yet is answered at once from the sample, while a background thread
+# computes the exact result into the cache. The page's dcc.Interval is
+# enabled until a poll finds it there and swaps it in.
+ESTIMATE_NOTE = dict(text='Estimated from a sample, exact figures to follow',
+                     xref='paper', yref='paper', x=1, y=1, xanchor='right', yanchor='bottom',
+                     showarrow=False, font={'size':11, 'color':'grey'})
+# hover value of an estimate, with the half-width of its 95% interval as
+# customdata; mirrored in assets/clientside.js
+ESTIMATE_HOVER = '%{y:,.3~f} ± %{customdata:,.3~f}'
+
+exact_jobs = ThreadPoolExecutor(max_workers=1, thread_name_prefix='exact')
+exact_pending = set()
+exact_lock = threading.Lock()
+
+def exact_later(func, *args):
+    """Run the memoized ``func(*args)`` in the background, once."""
+    key = (func.__name__, json.dumps(args, sort_keys=True))
+    with exact_lock:
+        if key in exact_pending:
+            return
+        exact_pending.add(key)
+    def run():
+        try:
+            with data_lock.shared():
+                func(*args)
+        except Exception:
+            server.logger.exception('Computing %s%r failed', func.__name__, args)
+        finally:
+            with exact_lock:
+                exact_pending.discard(key)
+    exact_jobs.submit(run)
+
+def answer(exact, estimate, *args):
+    """The memoized ``exact(*args)`` and True, or while it is computed,
+    ``estimate(*args)`` and False. Only selections, the last argument, are
+    estimated. A poll gets the exact result or no update."""
+    if sample is None or not args[-1]:
+        return exact(*args), True
+    result = exact.cached(*args)
+    if result is not None:
+        return result, True
+    exact_later(exact, *args)
+    if any(t['prop_id'].endswith('.n_intervals') for t in dash.callback_context.triggered):
+        raise dash.exceptions.PreventUpdate
+    return estimate(*args), False
+
+
 # __Home container callback__
 
 # In[17]:
 
 
-@app.callback(
-    [Output(component_id='subplot', component_property='figure'),
-     Output(component_id='bar', component_property='figure'),],
-    [Input(component_id='radio_options', component_property='value')]
-)
-
+# (dimension, trace name, row, col) of each subplot
+PANELS = [('Ship Mode', 'Shipping Mode', 1, 1),
+          ('Segment', 'Customer Segment', 1, 2),
+          ('Region', 'USA Region', 2, 1),
+          ('Category', 'Product Category', 2, 2)]
 
-def update_output(option):
+def subplot_figure(option):
+    from plotly.subplots import make_subplots
     
-    dff=df.copy()
-    dff.round(2)
+    fig = make_subplots(rows=2, cols=2, shared_yaxes=True)
     
-    if option=='Transactions':
-        
-        fig = make_subplots(rows=2, cols=2, shared_yaxes=True)
-        
-        fig.add_trace(go.Histogram(x=dff['Ship Mode'],name='Shipping Mode'),
-              row=1, col=1)
-        
-        fig.add_trace(go.Histogram(x=dff['Segment'],name='Customer Segment'),
-              row=1, col=2)
-        
-        fig.add_trace(go.Histogram(x=dff['Region'],name='USA Region'),
-              row=2, col=1)
-        
-        fig.add_trace(go.Histogram(x=dff['Category'],name='Product Category'),
-              row=2, col=2)
-        fig.update_layout(xaxis={'categoryorder':'category ascending'})
-        
-    else:
-        fig = make_subplots(rows=2, cols=2, shared_yaxes=True)
-        
-        ship=group_by(dff,'Ship Mode') 
-        fig.add_trace(go.Bar(x=ship['Ship Mode'],y=ship[option],name='Shipping Mode'),
-              row=1, col=1)
-        
-        seg=group_by(dff,'Segment')
-        fig.add_trace(go.Bar(x=seg['Segment'],y=seg[option],name='Customer Segment'),
-              row=1, col=2)
-        
-        reg=group_by(dff,'Region')
-        fig.add_trace(go.Bar(x=reg['Region'],y=reg[option],name='USA Region'),
-              row=2, col=1)
-        
-        cat=group_by(dff,'Category')
-        fig.add_trace(go.Bar(x=cat['Category'],y=cat[option],name='Product Category'),
-              row=2, col=2)
+    # 'Transactions' are counted server-side too: bars of the cube's
+    # per-value row counts draw the same chart as histograms of the raw column
+    for dim, name, row, col in PANELS:
+        grouped=cube[dim]
+        fig.add_trace(go.Bar(x=grouped[dim],y=grouped[option],name=name),
+              row=row, col=col)
         
     fig.update_layout(xaxis={'categoryorder':'category ascending'},
                       legend=dict(orientation="h",
@@ -600,10 +1292,11 @@ def update_output(option):
                       font=global_font,
                       font_color='black',
                       paper_bgcolor='rgba(0,0,0,0)', plot_bgcolor='rgba(0,0,0,0)')
+    return fig
+
+def state_bar_figure(option):
+    import plotly.express as px
     
-    if option=='Transactions':
-        option='Sales'
-       
     fig_3=px.bar(data_frame=states, x = 'State', y = option, 
                  color='Gross PM', 
                  color_continuous_scale='blues_r',color_continuous_midpoint=0,
@@ -615,26 +1308,163 @@ def update_output(option):
                                                font=global_font,
                                                legend={'font':legend_font}, font_color='black',
                                                paper_bgcolor='rgba(0,0,0,0)', plot_bgcolor='rgba(0,0,0,0)')
+    return fig_3
+
+@functools.lru_cache(maxsize=None)
+def subplot_skeleton():
+    return skeleton(subplot_figure('Sales'))
+
+@functools.lru_cache(maxsize=None)
+def state_bar_skeleton(option):
+    return skeleton(state_bar_figure(option))
+
+
+def home_store(panels=None, state_rollup=None):
+    """The aggregate tables and figure skeletons the clientside home callback
+    (assets/clientside.js) draws every tab from."""
+    panels = cube if panels is None else panels
+    state_rollup = states if state_rollup is None else state_rollup
+    metrics = ['Transactions', 'Sales', 'Profit', 'Quantity', 'Discount']
+    
+    estimate = 'Sales CI' in state_rollup.columns
     
-    return fig, fig_3
+    def table(frame, key):
+        columns = dict({'x':frame[key].tolist()},
+                       **{m: frame[m].tolist() for m in metrics + ['Gross PM']})
+        if estimate:
+            columns['ci'] = {m: frame[m + ' CI'].tolist() for m in metrics + ['Gross PM']}
+        return columns
+    
+    subplot = fill(subplot_skeleton(), [{'x':[], 'y':[]} for _ in PANELS])
+    bars = {option: fill(state_bar_skeleton(option), [{'x':[], 'y':[], 'marker':{'color':[]}}])
+            for option in metrics[1:]}
+    # every skeleton uses the same template; send it once
+    template = subplot['layout'].get('template')
+    for fig in [subplot] + list(bars.values()):
+        fig['layout'] = {k: v for k, v in fig['layout'].items() if k != 'template'}
+        if estimate:
+            fig['layout']['annotations'] = list(fig['layout'].get('annotations', [])) + [ESTIMATE_NOTE]
+    return {'template':template, 'subplot':subplot, 'bar':bars,
+            'panels':[table(panels[dim], dim) for dim, _, _, _ in PANELS],
+            'states':table(state_rollup, 'State')}
+
+
+# Tab switching only changes which preloaded table is plotted, so it runs in
+# the browser with no server round trip.
+app.clientside_callback(
+    ClientsideFunction(namespace='home', function_name='render'),
+    [Output(component_id='subplot', component_property='figure'),
+     Output(component_id='bar', component_property='figure'),],
+    [Input(component_id='radio_options', component_property='value'),
+     Input(component_id='home-aggregates', component_property='data')]
+)
 
 
-# __Page-1 Callback__
+# __Cross-filter Callbacks__
 
-# In[18]:
+state_names = dict(zip(states['state_code'], states['State']))
 
+@app.callback(
+    Output(component_id='selection', component_property='data'),
+    [Input(component_id='map', component_property='clickData'),
+     Input(component_id='subplot', component_property='clickData'),
+     Input(component_id='bar', component_property='clickData'),
+     Input(component_id='clear-selection', component_property='n_clicks'),],
+    [State(component_id='selection', component_property='data')]
+)
+def update_selection(map_click, subplot_click, bar_click, clear, selection):
+    # Clicking a value selects it, clicking it again deselects it
+    trigger = dash.callback_context.triggered[0]['prop_id']
+    if trigger == 'clear-selection.n_clicks':
+        return {}
+    if trigger == 'map.clickData':
+        dim, value = 'State', state_names[map_click['points'][0]['location']]
+    elif trigger == 'subplot.clickData':
+        point = subplot_click['points'][0]
+        dim, value = PANELS[point['curveNumber']][0], point['x']
+    elif trigger == 'bar.clickData':
+        dim, value = 'State', bar_click['points'][0]['x']
+    else:
+        raise dash.exceptions.PreventUpdate
+    
+    selection = dict(selection or {})
+    if selection.get(dim) == value:
+        del selection[dim]
+    else:
+        selection[dim] = value
+    return selection
+
+
+def describe(selection):
+    if not selection:
+        return 'Click a state or a bar to filter every chart.'
+    return 'Filtered to ' + ', '.join('{} = {}'.format(dim, value) for dim, value in selection.items())
 
 @app.callback(
-    Output(component_id='heat', component_property='figure'),
-    [Input(component_id='tabs', component_property='value'),
-     Input(component_id='product-dropdown', component_property='value'),]
+    Output(component_id='selection-label', component_property='children'),
+    [Input(component_id='selection', component_property='data')]
+)
+def home_selection_label(selection):
+    return describe(selection)
+
+@app.callback(
+    Output(component_id='selection-note', component_property='children'),
+    [Input(component_id='selection', component_property='data')]
+)
+def profit_selection_note(selection):
+    return describe(selection) if selection else ''
+
+
+@app.callback(
+    [Output(component_id='home-aggregates', component_property='data'),
+     Output(component_id='map', component_property='figure'),
+     Output(component_id='home-exact', component_property='disabled'),],
+    [Input(component_id='selection', component_property='data'),
+     Input(component_id='home-exact', component_property='n_intervals'),]
 )
+def filter_home(selection, polls):
+    # On the first render with nothing selected the layout is already right
+    if not selection and not dash.callback_context.triggered:
+        raise dash.exceptions.PreventUpdate
+    (store, figure), exact = answer(filtered_home, estimated_home, selection or {})
+    return store, figure, exact
+
+@memoize('home-filter')
+def filtered_home(selection):
+    if not selection:
+        return home_store(), map_figure()
+    if df is None:
+        panels = selected_summary(selection)['cube']
+        return home_store(panels, panels['State']), map_figure(panels['State'])
+    # each panel, and the state charts, ignore their own dimension
+    panels = {dim: group_by(select(without(selection, dim)), dim) for dim in DIMENSIONS}
+    filtered_states = state_(select(without(selection, 'State')))
+    return home_store(panels, filtered_states), map_figure(filtered_states)
+
+def estimated_home(selection):
+    panels = {dim: sample.group_by(dim, without(selection, dim)) for dim in DIMENSIONS}
+    estimated_states = sample.group_by(['State','state_code','Region'], without(selection, 'State')
+                                      ).sort_values('Sales', ascending=False, ignore_index=True)
+    return home_store(panels, estimated_states), map_figure(estimated_states)
+
+
+# Without rows, a selection is aggregated by a pass over the CSV; the home
+# page and page-1 callbacks share it
+def selected_summary(selection):
+    return _selected_summary(tuple(sorted(selection.items())))
+
+@single_flight(maxsize=16)
+def _selected_summary(items):
+    return aggregates.run(DATA_FILE, dict(items), AGGREGATE_JOBS, AGGREGATE_MEMORY)
+
+
+# __Page-1 Callback__
+
+# In[18]:
 
 
-def update_output(tab, product):
-    dff=df.copy()
-    dff['Gross PM']=np.multiply(np.divide(dff['Profit'],dff['Sales']),100).round(2)
-    dff.round(2)
+def discount_figure(data, tab, by_category):
+    import plotly.express as px
     
     legend={'font':legend_font,
             'title':{'text':'Click categories to select/deselect', 'side':'top'},
@@ -644,12 +1474,10 @@ def update_output(tab, product):
             'bordercolor':'grey','borderwidth':1
            }
     
-    if product==None:
-        data = group_by(dff,['Discount','Category']).sort_values('Discount',ascending=True,ignore_index=True)
+    if by_category:
         fig_3=px.bar(data, x='Discount', y=tab,
                     color="Category", barmode="group")
     else:
-        data = group_by(dff[dff['Sub-Category']==product],'Discount').sort_values('Discount',ascending=True,ignore_index=True)
         fig_3=px.bar(data, x='Discount', y=tab)
         
         
@@ -662,15 +1490,310 @@ def update_output(tab, product):
     fig_3.update_xaxes(showgrid=True)
     
     return fig_3
-    
 
+@functools.lru_cache(maxsize=None)
+def discount_skeleton(tab, by_category):
+    # one trace per category, or a single trace for a sub-category
+    product = None if by_category else discount_tensor['Sub-Category'][0][0]
+    return skeleton(discount_figure(discount_frame(product), tab, by_category))
+
+def draw_discount(data, tab, by_category):
+    """The discount_skeleton filled with ``data``, a discount_frame or an
+    estimate of one, whose intervals are shown on hover."""
+    fig = discount_skeleton(tab, by_category)
+    estimate = tab + ' CI' in data.columns
+    traces = []
+    for trace in fig['data']:
+        rows = data[data['Category']==trace['name']] if by_category else data
+        if by_category and not len(rows):
+            traces.append(None)
+            continue
+        arrays = {'x':rows['Discount'], 'y':rows[tab]}
+        if estimate:
+            arrays['customdata'] = rows[tab + ' CI']
+            arrays['hovertemplate'] = trace['hovertemplate'].replace('%{y}', ESTIMATE_HOVER)
+        traces.append(arrays)
+    fig = fill(fig, traces)
+    if estimate:
+        fig['layout'] = dict(fig['layout'], annotations=[ESTIMATE_NOTE])
+    return fig
 
-# ### Launching web application dashboard
+
+@app.callback(
+    [Output(component_id='heat', component_property='figure'),
+     Output(component_id='heat-exact', component_property='disabled'),],
+    [Input(component_id='tabs', component_property='value'),
+     Input(component_id='product-dropdown', component_property='value'),
+     Input(component_id='selection', component_property='data'),
+     Input(component_id='heat-exact', component_property='n_intervals'),]
+)
+def render_heat(tab, product, selection, polls):
+    return answer(update_output, estimated_output, tab, product, selection)
+
+@memoize('page-1')
+def update_output(tab, product, selection=None):
+    tensor = None
+    if selection and df is not None:
+        tensor = build_discount_tensor(select(selection))
+    elif selection:
+        # on the categories of the whole data, like the rows select() returns
+        table = selected_summary(selection)['discount']
+        tensor = build_discount_tensor(with_categories(table, {dim: summary['discount'][dim].cat.categories
+                                                               for dim in ['Category', 'Sub-Category']}))
+    if product==None:
+        return draw_discount(discount_frame(tensor=tensor), tab, True)
+    return draw_discount(discount_frame(product, tensor), tab, False)
+
+def estimated_output(tab, product, selection):
+    if product==None:
+        return draw_discount(sample.group_by(['Discount','Category'], selection), tab, True)
+    return draw_discount(sample.group_by('Discount', dict(selection, **{'Sub-Category': product})), tab, False)
+
+
+@app.callback(
+    [Output(component_id='sunburst', component_property='figure'),
+     Output(component_id='box', component_property='figure'),],
+    [Input(component_id='selection', component_property='data')]
+)
+def filter_profit_page(selection):
+    # The selection only changes on the home page, so this runs when page-1
+    # is rendered; unfiltered, the figures already in the layout stand.
+    if not selection:
+        raise dash.exceptions.PreventUpdate
+    return filtered_profit_figures(selection)
+
+@memoize('page-1-static')
+def filtered_profit_figures(selection):
+    if df is None:
+        selected = selected_summary(selection)
+        return sunburst_figure(selected['sunburst']), box_figure(selected['box'])
+    rows = select(selection)
+    return (sunburst_figure(aggregates.sunburst_leaves(aggregates.sunburst_sums(rows))),
+            box_figure(aggregates.box_counts(rows)))
+
+
+# ### Incremental ingestion
 
 # In[19]:
 
 
+# New transactions dropped into INGEST_DIR, as CSVs in the cleaned_df.csv
+# format, are appended while the app runs. Only the batch is grouped: the
+# cube, the state rollup, the discount tensor and the KPI sums all hold
+# sums and counts, so the batch's aggregates are merged into them, with the
+# Discount means weighted by their Transactions. The rows themselves are
+# appended and their posting lists extended; the box plot and sunburst,
+# which need every row, are rebuilt on the next page load.
+# Files are taken in name order and never modified, so write each one under
+# another name (e.g. .csv.tmp) and rename it into place when complete.
+INGEST_DIR = os.environ.get('INGEST_DIR')
+INGEST_INTERVAL = float(os.environ.get('INGEST_INTERVAL', 5))
+ingested = []
+rejected = set()
+ingest_lock = threading.RLock()
+
+
+class SharedLock:
+    """Held by any number of readers at once, or by one writer. A writer
+    waiting for the readers to finish holds off new ones."""
+
+    def __init__(self):
+        self._changed = threading.Condition()
+        self._readers = 0
+        self._writers = 0  # waiting or writing
+
+    def acquire_shared(self):
+        with self._changed:
+            while self._writers:
+                self._changed.wait()
+            self._readers += 1
+
+    def release_shared(self):
+        with self._changed:
+            self._readers -= 1
+            if not self._readers:
+                self._changed.notify_all()
+
+    @contextlib.contextmanager
+    def shared(self):
+        self.acquire_shared()
+        try:
+            yield
+        finally:
+            self.release_shared()
+
+    @contextlib.contextmanager
+    def exclusive(self):
+        with self._changed:
+            self._writers += 1
+            while self._readers:
+                self._changed.wait()
+        try:
+            yield
+        finally:
+            with self._changed:
+                self._writers -= 1
+                self._changed.notify_all()
+
+
+# A request reads several of the globals ingest() replaces (df and
+# row_index, the cube, the caches built from them) and threaded workers
+# serve many at once, so every request holds data_lock shared and ingest()
+# swaps the globals holding it exclusively: a request sees the data from
+# before a batch or after it, never a mix.
+data_lock = SharedLock()
+
+
+def with_categories(frame, categories):
+    """``frame`` with its categorical columns set to ``categories``."""
+    return frame.assign(**{col: frame[col].cat.set_categories(cats)
+                           for col, cats in categories.items()
+                           if col in frame.columns and not frame[col].cat.categories.equals(cats)})
+
+def merge_grouped(old, new, keys):
+    """Two group_by/state_ results combined as if grouped in one pass."""
+    both = pd.concat([old, new], ignore_index=True)
+    both['Discount'] = both['Discount'] * both['Transactions']
+    merged = both.groupby(keys, as_index=False, observed=True).agg(
+        {m: 'sum' for m in ['Sales', 'Profit', 'Quantity', 'Discount', 'Transactions']})
+    merged['Discount'] = merged['Discount'] / merged['Transactions']
+    merged['Gross PM']=np.multiply(np.divide(merged['Profit'],merged['Sales']),100).round(2)
+    return merged[list(old.columns)]
+
+def merge_tensor(old, new):
+    """Two discount tensors summed onto the union of their discount levels.
+    The categories of ``new`` must extend those of ``old``."""
+    levels = np.union1d(old['levels'], new['levels'])
+    merged = {'levels': levels}
+    for dim in ['Sub-Category', 'Category']:
+        categories = new[dim][0]
+        sums = np.zeros((len(categories), len(levels), len(TENSOR_METRICS)))
+        for part in (old, new):
+            part_categories, part_sums = part[dim]
+            sums[:len(part_categories), np.searchsorted(levels, part['levels'])] += part_sums
+        merged[dim] = (categories, sums)
+    return merged
+
+def extend_index(old, new, offset):
+    """``old`` with the posting lists ``new`` built for rows appended at
+    ``offset``. The categories of ``new`` must extend those of ``old``."""
+    index = {}
+    for dim, entry in new.items():
+        postings = old[dim]['postings']
+        empty = np.empty(0, dtype=np.intp)
+        index[dim] = {'categories': entry['categories'],
+                      'codes': np.concatenate([old[dim]['codes'], entry['codes']]),
+                      'postings': [np.concatenate([postings[i] if i < len(postings) else empty, rows + offset])
+                                   for i, rows in enumerate(entry['postings'])]}
+    return index
+
+
+def ingest(batch, source):
+    """Append the cleaned rows of ``batch``, read from ``source``, and fold
+    them into every aggregate."""
+    global df, row_index, cube, states, discount_tensor, kpi_table, kpis, state_names, bundle, sample
+    with ingest_lock:
+        batch = datastore.derive(datastore.apply_schema(batch.reset_index(drop=True)))[list(df.columns)]
+        # Values never seen before are added after the known ones, so the
+        # codes already held by df, the index and the tensor stay valid
+        categories = {}
+        for col in df.columns:
+            if isinstance(df[col].dtype, pd.CategoricalDtype):
+                known = df[col].cat.categories
+                categories[col] = known.append(batch[col].cat.categories.difference(known))
+        batch = with_categories(batch, categories)
+
+        grown = {dim: merge_grouped(with_categories(cube[dim], categories), group_by(batch, dim), [dim])
+                 for dim in DIMENSIONS}
+        grown['State'] = merge_grouped(with_categories(cube['State'], categories), state_(batch),
+                                       ['State', 'state_code', 'Region']
+                                      ).sort_values('Sales', ascending=False, ignore_index=True)
+        grown_tensor = merge_tensor(discount_tensor, build_discount_tensor(batch))
+        grown_index = extend_index(row_index, build_index(batch), len(df))
+        combined = pd.concat([with_categories(df, categories), batch], ignore_index=True)
+
+        grown_kpi = aggregates.merge([{'kpi': kpi_table}, {'kpi': aggregates.kpi_sums(batch)}]
+                                    )['kpi'].sort_values('Discount', ignore_index=True)
+        # the batch's rows drawn and merged in; seeded by where they start
+        grown_sample = sample.extend(batch, SAMPLE_ROWS, seed=len(df)) if sample is not None else None
+
+        with data_lock.exclusive():
+            # df goes first: until row_index follows, the old postings still
+            # point at the same rows of the longer frame
+            df, row_index = combined, grown_index
+            cube, states, discount_tensor = grown, grown['State'], grown_tensor
+            kpi_table, kpis = grown_kpi, aggregates.kpis(grown_kpi)
+            sample = grown_sample
+            state_names = dict(zip(states['state_code'], states['State']))
+            ingested.append(source)
+            bundle = None
+
+            cache.invalidate(cache_version(DATA_FILE, ingested))
+            for cached in (home_page, profit_page, conclusion_page, page_response,
+                           subplot_skeleton, state_bar_skeleton, discount_skeleton):
+                cached.cache_clear()
+
+
+def ingest_pending():
+    """Ingest the files in INGEST_DIR not seen yet, in name order."""
+    with ingest_lock:
+        for name in sorted(os.listdir(INGEST_DIR)):
+            if not name.endswith('.csv') or name in ingested or name in rejected:
+                continue
+            try:
+                batch = datastore.read_csv(os.path.join(INGEST_DIR, name))
+            except (ValueError, pd.errors.ParserError):
+                # a malformed file is skipped for good rather than retried
+                server.logger.exception('Rejected %s', name)
+                rejected.add(name)
+                continue
+            ingest(batch, name)
+            server.logger.info('Ingested %s: %d rows, %d total', name, len(batch), len(df))
+
+def watch_ingest_dir():
+    while True:
+        time.sleep(INGEST_INTERVAL)
+        try:
+            ingest_pending()
+        except Exception:
+            server.logger.exception('Ingesting from %s failed', INGEST_DIR)
+
+
+# Each process catches up before serving its first request, then polls.
+# (Threads don't survive a fork, so a preloaded master can't start this.)
+@server.before_first_request
+def start_ingest():
+    if INGEST_DIR and df is None:
+        server.logger.warning('INGEST_DIR is ignored with DATA_MODE=aggregates')
+    elif INGEST_DIR:
+        ingest_pending()
+        threading.Thread(target=watch_ingest_dir, name='ingest', daemon=True).start()
+
+
+def hold_data():
+    data_lock.acquire_shared()
+    flask.g.holds_data = True
+
+def release_data(exc):
+    if flask.g.pop('holds_data', False):
+        data_lock.release_shared()
+
+if INGEST_DIR and df is not None:
+    # first, so the routed pages and precomputed responses hold it too
+    server.before_request_funcs.setdefault(None, []).insert(0, hold_data)
+    server.teardown_request(release_data)
+
+
+
+# ### Launching web application dashboard
+
+# In[20]:
+
+
 if __name__=='__main__':
+    # fork the cross-filter passes' processes before the server's threads
+    if DATA_MODE == 'aggregates':
+        aggregates.start_pool(AGGREGATE_JOBS)
     app.run_server(debug=True, use_reloader=False)  
 
 
@@ -0,0 +1,30 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_FILE = os.path.join(ROOT, 'cleaned_df.csv')
+
+sys.path.insert(0, ROOT)
+# for the tests that import the app: the sample data, a cache of their own
+# and nothing precomputed
+os.environ['DATA_FILE'] = DATA_FILE
+os.environ['CACHE_DIR'] = tempfile.mkdtemp(prefix='retail-dash-test-cache-')
+os.environ['PRECOMPUTED_DIR'] = ''
+os.environ.pop('SAMPLE_ROWS', None)
+os.environ.pop('INGEST_DIR', None)
+os.environ.pop('DATA_MODE', None)
+
+
+@pytest.fixture(scope='session')
+def rows():
+    import datastore
+    return datastore.load(DATA_FILE)
+
+
+@pytest.fixture(scope='session')
+def sidebar():
+    import sidebar
+    return sidebar
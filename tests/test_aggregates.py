@@ -0,0 +1,135 @@
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+import http.client
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import aggregates
+import loadtest
+
+DATA_FILE = os.environ['DATA_FILE']
+
+SELECTIONS = [None, {'Region': 'West'}, {'State': 'Texas', 'Category': 'Furniture'},
+              {'Segment': 'Consumer', 'Ship Mode': 'First Class', 'Region': 'East'}]
+MEMORY_LIMIT = 2**20
+JOBS = 2
+
+
+def normalized(frame, keys):
+    frame = frame.astype({key: str for key in keys if isinstance(frame[key].dtype, pd.CategoricalDtype)})
+    return frame.sort_values(keys, ignore_index=True)
+
+
+def assert_same(result, expected, keys):
+    pd.testing.assert_frame_equal(normalized(result, keys), normalized(expected[list(result.columns)], keys),
+                                  check_dtype=False)
+
+
+@pytest.fixture(scope='module', params=SELECTIONS, ids=lambda selection: str(selection or 'all'))
+def out_of_core(request):
+    # blocks well below the floor kept for real files, so that there are
+    # enough of them to be merged along the way
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr(aggregates, 'MIN_BLOCK_BYTES', 2**12)
+        return request.param, aggregates.run(DATA_FILE, request.param, jobs=JOBS, memory_limit=MEMORY_LIMIT)
+
+
+def test_several_blocks():
+    block_bytes = MEMORY_LIMIT // (2 * JOBS * aggregates.BLOCK_OVERHEAD)
+    with open(DATA_FILE, 'rb') as f:
+        f.readline()
+        assert sum(1 for _ in aggregates.blocks(f, block_bytes)) > 8
+
+
+def test_cube(sidebar, rows, out_of_core):
+    selection, result = out_of_core
+    selection = selection or {}
+    for dim in aggregates.DIMENSIONS:
+        expected = sidebar.group_by(aggregates.where(rows, aggregates.without(selection, dim)), dim)
+        assert_same(result['cube'][dim], expected, [dim])
+    expected = sidebar.state_(aggregates.where(rows, aggregates.without(selection, 'State')))
+    assert_same(result['cube']['State'], expected, aggregates.STATE_KEYS)
+    assert list(result['cube']['State']['State']) == list(expected['State'])
+
+
+def test_discount_box_and_sunburst(rows, out_of_core):
+    selection, result = out_of_core
+    selected = aggregates.where(rows, selection or {})
+    expected = selected.groupby(aggregates.DISCOUNT_KEYS, as_index=False, observed=True).agg(
+        Sales=('Sales', 'sum'), Profit=('Profit', 'sum'), Quantity=('Quantity', 'sum'),
+        Transactions=('Sales', 'size'))
+    assert_same(result['discount'], expected, aggregates.DISCOUNT_KEYS)
+    assert_same(result['box'], aggregates.box_counts(selected), aggregates.BOX_KEYS)
+    # in the order Plotly Express lays the leaves out: by first appearance
+    expected = aggregates.sunburst_leaves(aggregates.sunburst_sums(selected))
+    pd.testing.assert_frame_equal(result['sunburst'].astype({key: str for key in aggregates.SUNBURST_KEYS}),
+                                  expected.astype({key: str for key in aggregates.SUNBURST_KEYS}), check_dtype=False)
+
+
+def test_kpis(rows, out_of_core):
+    _, result = out_of_core
+    assert_same(result['kpi'], aggregates.kpi_sums(rows), ['Discount'])
+    assert int(result['kpi']['Transactions'].sum()) == len(rows)
+    assert np.isclose(result['kpi']['Sales'].sum(), rows['Sales'].sum())
+
+
+def post(port, body):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+    conn.request('POST', '/_dash-update-component', json.dumps(body), {'Content-Type': 'application/json'})
+    response = conn.getresponse()
+    return response.status, response.read()
+
+
+def cross_filter(port, selection):
+    outputs = [{'id': 'home-aggregates', 'property': 'data'}, {'id': 'map', 'property': 'figure'},
+               {'id': 'home-exact', 'property': 'disabled'}]
+    return post(port, {'output': '..home-aggregates.data...map.figure...home-exact.disabled..',
+                       'outputs': outputs,
+                       'inputs': [{'id': 'selection', 'property': 'data', 'value': selection},
+                                  {'id': 'home-exact', 'property': 'n_intervals', 'value': 0}],
+                       'changedPropIds': ['selection.data']})
+
+
+@pytest.mark.skipif(not os.path.isdir('/proc/self'), reason='needs Linux /proc')
+def test_app_starts_without_aggregates(tmp_path):
+    # `python sidebar.py` in aggregates mode, with the aggregates still to
+    # be built: neither that build nor the passes the cross-filters make may
+    # import the app again in their processes
+    data_file = tmp_path / 'data.csv'
+    shutil.copy(DATA_FILE, data_file)
+    port = loadtest.free_port()
+    env = dict(os.environ, DATA_MODE='aggregates', DATA_FILE=str(data_file), AGGREGATE_JOBS=str(JOBS),
+               CACHE_DIR=str(tmp_path / 'cache'), PORT=str(port))
+    log = tempfile.TemporaryFile()
+    process = subprocess.Popen([sys.executable, 'sidebar.py'], cwd=os.path.dirname(aggregates.__file__),
+                               env=env, stdout=log, stderr=subprocess.STDOUT)
+    try:
+        deadline = time.monotonic() + 120
+        while process.poll() is None and time.monotonic() < deadline:
+            try:
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+                conn.request('GET', '/_dash-layout')
+                if conn.getresponse().status == 200:
+                    break
+            except OSError:
+                time.sleep(0.5)
+        log.seek(0)
+        assert process.poll() is None, log.read().decode(errors='replace')[-2000:]
+        assert os.path.exists(aggregates.summary_path(str(data_file)))
+        pool = loadtest.children(process.pid)
+        assert len(pool) == JOBS
+        for selection in [{'Region': 'West'}, {'Region': 'West', 'Category': 'Technology'}]:
+            status, body = cross_filter(port, selection)
+            assert status == 200, body[-2000:]
+        # the same processes answered both
+        assert loadtest.children(process.pid) == pool
+    finally:
+        process.terminate()
+        process.wait(30)
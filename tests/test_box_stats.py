@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+import aggregates
+
+
+@pytest.fixture(scope='module')
+def counts(rows):
+    return aggregates.box_counts(rows)
+
+
+def outliers_of(values):
+    q1, q3 = np.quantile(values, [0.25, 0.75], method='hazen')
+    iqr = q3 - q1
+    inside = values[(values >= q1 - 1.5 * iqr) & (values <= q3 + 1.5 * iqr)]
+    return inside, values[(values < inside.min()) | (values > inside.max())]
+
+
+def test_statistics_match_plotly(sidebar, rows, counts):
+    stats = sidebar.box_stats(counts, 'Discount', 'Gross PM', max_outliers=len(rows)).set_index('Discount')
+    assert list(stats.index) == sorted(rows['Discount'].unique())
+    for discount, group in rows.groupby('Discount'):
+        values = np.sort(group['Gross PM'].to_numpy(dtype=float))
+        row = stats.loc[discount]
+        expected = np.quantile(values, [0.25, 0.5, 0.75], method='hazen')
+        assert [row['q1'], row['median'], row['q3']] == pytest.approx(expected)
+        inside, outliers = outliers_of(values)
+        assert (row['lowerfence'], row['upperfence']) == (inside.min(), inside.max())
+        assert row['mean'] == pytest.approx(values.mean())
+        assert np.array_equal(np.sort(row['outliers']), outliers)
+
+
+@pytest.mark.parametrize('cap', [0, 1, 5, 13, 40, 100, 1000])
+def test_outliers_are_capped(sidebar, rows, counts, cap):
+    stats = sidebar.box_stats(counts, 'Discount', 'Gross PM', max_outliers=cap).set_index('Discount')
+    groups = {discount: outliers_of(np.sort(group['Gross PM'].to_numpy(dtype=float)))[1]
+              for discount, group in rows.groupby('Discount')}
+    total = sum(len(outliers) for outliers in groups.values())
+    kept = sum(len(outliers) for outliers in stats['outliers'])
+    assert kept == min(cap, total)
+    room = 2 * sum(len(outliers) > 0 for outliers in groups.values()) <= cap
+    for discount, outliers in groups.items():
+        picked = stats.loc[discount, 'outliers']
+        assert np.isin(picked, outliers).all()
+        if room and len(outliers):
+            assert picked.min() == outliers.min() and picked.max() == outliers.max()
+
+
+def test_figure_draws_no_mean(sidebar):
+    # as px.box drew it: the mean is given, but not drawn as a dashed line
+    box = sidebar.box_figure().data[0]
+    assert box.type == 'box' and box.boxmean is False
@@ -0,0 +1,27 @@
+import precompute
+
+
+def test_version_follows_data_and_code(sidebar, monkeypatch):
+    version = sidebar.cache_version(sidebar.DATA_FILE)
+    assert sidebar.cache.version == version
+    assert precompute.code_hash()[:16] in version
+    assert sidebar.cache_version(sidebar.DATA_FILE, ['a.csv', 'b.csv']) == version + '+a.csv,b.csv'
+    monkeypatch.setattr(sidebar, 'code_version', 'changed')
+    assert sidebar.cache_version(sidebar.DATA_FILE) != version
+
+
+def test_other_code_misses_the_shared_cache(sidebar, tmp_path):
+    ours = sidebar.FigureCache(str(tmp_path), version='data:code-1')
+    theirs = sidebar.FigureCache(str(tmp_path), version='data:code-2')
+    ours.set(ours.key('page', ['/']), '{"data": []}')
+    assert sidebar.FigureCache(str(tmp_path), version='data:code-1').get(ours.key('page', ['/'])) == '{"data": []}'
+    assert theirs.get(theirs.key('page', ['/'])) is None
+
+
+def test_request_key_ignores_selection_order():
+    def payload(selection):
+        return {'output': precompute.SELECTION_OUTPUTS[0],
+                'inputs': [{'id': 'selection', 'property': 'data', 'value': selection}]}
+    key = precompute.request_key(payload({'State': 'Texas', 'Category': 'Furniture'}))
+    assert precompute.request_key(payload({'Category': 'Furniture', 'State': 'Texas'})) == key
+    assert precompute.request_key(payload({'State': 'Texas'})) != key
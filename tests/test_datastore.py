@@ -0,0 +1,28 @@
+import os
+import shutil
+
+import pandas as pd
+
+import datastore
+
+DATA_FILE = os.environ['DATA_FILE']
+
+
+def test_rebuild_leaves_loaded_store_alone(tmp_path):
+    data_file = tmp_path / 'data.csv'
+    shutil.copy(DATA_FILE, data_file)
+    store = datastore.build(str(data_file))
+    loaded = datastore.load_store(store)
+    before = loaded.copy(deep=True)
+
+    # a smaller file, as a rebuild in place would have shrunk the maps
+    half = pd.read_csv(data_file).iloc[::2]
+    half.to_csv(data_file, index=False)
+    assert not datastore.is_fresh(str(data_file))
+    datastore.build(str(data_file))
+
+    pd.testing.assert_frame_equal(loaded.copy(deep=True), before)
+    assert datastore.is_fresh(str(data_file))
+    assert len(datastore.load(str(data_file))) == len(half)
+    # only the new build's files are left
+    assert len([name for name in os.listdir(store) if name.endswith('.npy')]) == len(loaded.columns)
@@ -0,0 +1,51 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import aggregates
+
+MEASURES = ['Sales', 'Profit', 'Quantity', 'Discount']
+KEYS = [['Ship Mode'], ['Discount', 'Category'], ['State', 'state_code', 'Region'],
+        # more key combinations than rows: grouped by np.unique
+        ['City', 'Sales']]
+
+
+def expected(rows, keys):
+    columns = [col for col in MEASURES if col not in keys]
+    return rows.groupby(keys, as_index=False, observed=True).agg(
+        **{col: (col, 'sum') for col in columns}, Transactions=(columns[0], 'size'))
+
+
+def assert_matches(rows, keys):
+    result = aggregates.group_sums(rows, keys, [col for col in MEASURES if col not in keys])
+    pandas = expected(rows, keys)
+    pd.testing.assert_frame_equal(result, pandas, check_dtype=False)
+    # integer sums are widened to int64, where pandas keeps int16
+    assert [dtype.kind for dtype in result.dtypes] == [dtype.kind for dtype in pandas.dtypes]
+
+
+@pytest.mark.parametrize('keys', KEYS, ids=','.join)
+def test_matches_pandas(rows, keys):
+    assert_matches(rows, keys)
+
+
+def test_both_paths_are_covered(rows):
+    cells = {tuple(keys): np.prod([rows[key].nunique() for key in keys]) for keys in KEYS}
+    assert cells[('City', 'Sales')] > max(len(rows), 2**16)
+    assert cells[('Ship Mode',)] <= 2**16
+
+
+@pytest.mark.parametrize('keys', KEYS, ids=','.join)
+def test_missing_keys_are_left_out(rows, keys):
+    rows = rows.copy()
+    for i, key in enumerate(keys):
+        rows.loc[rows.index[i::7], key] = np.nan
+    assert rows[keys].isna().any(axis=1).any()
+    assert_matches(rows, keys)
+
+
+@pytest.mark.parametrize('keys', KEYS, ids=','.join)
+def test_empty(rows, keys):
+    result = aggregates.group_sums(rows.iloc[:0], keys, [col for col in MEASURES if col not in keys])
+    assert len(result) == 0
+    assert list(result.columns) == list(expected(rows.iloc[:0], keys).columns)
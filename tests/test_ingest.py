@@ -0,0 +1,97 @@
+import importlib.util
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import datastore
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_app(name, data_file):
+    """A fresh instance of the app on ``data_file``."""
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setenv('DATA_FILE', str(data_file))
+        spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, 'sidebar.py'))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(scope='module')
+def apps(tmp_path_factory):
+    """The app on the first rows with batches ingested after, and the app
+    loaded from all of them at once."""
+    tmp = tmp_path_factory.mktemp('ingest')
+    rows = pd.read_csv(os.path.join(ROOT, 'cleaned_df.csv'))
+    base, first, second, third = rows.iloc[:7000], rows.iloc[7000:8000].copy(), rows.iloc[8000:9000].copy(), rows.iloc[9000:]
+    # a state, a sub-category and a discount level the base rows don't have
+    first.iloc[::3, first.columns.get_loc('State')] = 'Puerto Rico'
+    first.iloc[::3, first.columns.get_loc('state_code')] = 'PR'
+    second.iloc[::4, second.columns.get_loc('Sub-Category')] = 'Drones'
+    second.iloc[::5, second.columns.get_loc('Discount')] = 0.35
+    base.to_csv(tmp / 'base.csv', index=False)
+    pd.concat([base, first, second, third]).to_csv(tmp / 'combined.csv', index=False)
+
+    ingested = load_app('sidebar_ingested', tmp / 'base.csv')
+    for i, batch in enumerate([first, second, third]):
+        path = tmp / 'batch{}.csv'.format(i)
+        batch.to_csv(path, index=False)
+        ingested.ingest(datastore.read_csv(path), path.name)
+    fresh = load_app('sidebar_fresh', tmp / 'combined.csv')
+    yield ingested, fresh
+    for name in ('sidebar_ingested', 'sidebar_fresh'):
+        sys.modules.pop(name, None)
+
+
+def normalized(frame, keys):
+    # new values are appended to the categories rather than sorted in
+    frame = frame.astype({key: str for key in keys if isinstance(frame[key].dtype, pd.CategoricalDtype)})
+    return frame.sort_values(keys, ignore_index=True)
+
+
+def test_cube(apps):
+    ingested, fresh = apps
+    assert set(ingested.cube) == set(fresh.cube)
+    for dim, table in fresh.cube.items():
+        keys = ['State', 'state_code', 'Region'] if dim == 'State' else [dim]
+        pd.testing.assert_frame_equal(normalized(ingested.cube[dim], keys), normalized(table, keys),
+                                      check_dtype=False, check_categorical=False)
+    assert list(ingested.states['State']) == list(fresh.states['State'])
+    assert 'Puerto Rico' in set(fresh.states['State'])
+
+
+def test_discount_frame(apps):
+    ingested, fresh = apps
+    assert 'Drones' in fresh.discount_tensor['Sub-Category'][0]
+    assert 0.35 in fresh.discount_tensor['levels']
+    for product in [None] + list(fresh.discount_tensor['Sub-Category'][0]):
+        keys = ['Discount', 'Category'] if product is None else ['Discount']
+        pd.testing.assert_frame_equal(normalized(ingested.discount_frame(product), keys),
+                                      normalized(fresh.discount_frame(product), keys), check_dtype=False)
+
+
+def test_kpis(apps):
+    ingested, fresh = apps
+
+    def numbers(kpis):
+        return {k: v for k, v in kpis.items() if not isinstance(v, (str, list))}
+
+    assert numbers(ingested.kpis) == pytest.approx(numbers(fresh.kpis))
+    assert [band['Band'] for band in ingested.kpis['Bands']] == [band['Band'] for band in fresh.kpis['Bands']]
+    for band, expected in zip(ingested.kpis['Bands'], fresh.kpis['Bands']):
+        assert numbers(band) == pytest.approx(numbers(expected))
+
+
+@pytest.mark.parametrize('selection', [
+    {'State': 'Puerto Rico'}, {'Sub-Category': 'Drones'}, {'State': 'Texas', 'Category': 'Furniture'},
+    {'Region': 'West', 'Segment': 'Consumer'}, {'Sub-Category': 'Drones', 'Region': 'East'},
+    {'State': 'Atlantis'}])
+def test_filter_rows(apps, selection):
+    ingested, fresh = apps
+    assert np.array_equal(ingested.filter_rows(selection), fresh.filter_rows(selection))
+    assert len(ingested.df) == len(fresh.df)
@@ -0,0 +1,56 @@
+import itertools
+
+import pandas as pd
+
+
+SELECTIONS = [{}, {'State': 'Texas'}, {'Region': 'Central', 'Category': 'Furniture'},
+              {'Segment': 'Consumer', 'Ship Mode': 'First Class'}, {'State': 'Texas', 'Region': 'West'}]
+
+
+def calls(sidebar):
+    """(callback, input values, state values) for every server callback,
+    over a spread of inputs."""
+    clicks = [({'points': [{'location': 'TX'}]}, None, None, None),
+              (None, {'points': [{'curveNumber': 0, 'x': 'Consumer'}]}, None, None),
+              (None, None, {'points': [{'x': 'Texas'}]}, None),
+              (None, None, None, 1)]
+    values = {
+        'page-content.children': [(path,) for path in list(sidebar.PAGES) + ['/missing']],
+        'selection.data': clicks,
+        'selection-label.children': [(selection,) for selection in SELECTIONS],
+        'selection-note.children': [(selection,) for selection in SELECTIONS],
+        '..home-aggregates.data...map.figure...home-exact.disabled..':
+            [(selection, 0) for selection in SELECTIONS],
+        '..heat.figure...heat-exact.disabled..':
+            [(tab, product, selection, 0) for tab, product, selection
+             in itertools.product(['Profit', 'Quantity'], [None, 'Chairs', 'Copiers'], SELECTIONS)],
+        '..sunburst.figure...box.figure..': [(selection,) for selection in SELECTIONS],
+    }
+    assert set(values) == {output for output, callback in sidebar.app.callback_map.items() if 'callback' in callback}
+    for output, inputs in values.items():
+        callback = sidebar.app.callback_map[output]
+        for args in inputs:
+            # the clicks are each their input's trigger
+            changed = next((i for i, value in enumerate(args) if value is not None), 0)
+            yield output, callback, args, changed
+
+
+def test_callbacks_leave_df_untouched(sidebar):
+    frame = sidebar.df
+    before = frame.copy(deep=True)
+    cube = {dim: table.copy(deep=True) for dim, table in sidebar.cube.items()}
+    client = sidebar.server.test_client()
+    for output, callback, args, changed in calls(sidebar):
+        spec = callback['inputs'][changed]
+        body = {'output': output,
+                'inputs': [dict(spec, value=value) for spec, value in zip(callback['inputs'], args)],
+                'state': [dict(spec, value={}) for spec in callback['state']],
+                'changedPropIds': ['{id}.{property}'.format(**spec)]}
+        response = client.post('/_dash-update-component', json=body)
+        assert response.status_code in (200, 204), (output, args)
+
+    assert sidebar.df is frame
+    # copied as before: the store's columns are memory maps
+    pd.testing.assert_frame_equal(frame.copy(deep=True), before)
+    for dim, table in cube.items():
+        pd.testing.assert_frame_equal(sidebar.cube[dim], table)
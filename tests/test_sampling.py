@@ -0,0 +1,51 @@
+import os
+import pickle
+import shutil
+
+import numpy as np
+
+import aggregates
+import sampling
+import loadtest
+
+
+def test_intervals_cover_the_exact_values(rows):
+    coverage, left_out = sampling.check(rows, 2000, seeds=5)
+    covered, estimated = map(sum, zip(*coverage.values()))
+    assert estimated > 0
+    assert covered / estimated >= 0.9
+    for col, (covered, estimated) in coverage.items():
+        assert covered / estimated >= 0.85, col
+
+
+def test_groups_without_support_are_left_out(rows):
+    sample = sampling.StratifiedSample.draw(rows, 2000, seed=0)
+    for keys, selection in [('State', {}), ('Sub-Category', {'Region': 'West'}), ('Ship Mode', {'Segment': 'Home Office'})]:
+        support = aggregates.where(sample.rows, selection).groupby(keys, observed=True).size()
+        estimate = sample.group_by(keys, selection)
+        assert set(estimate[keys]) == set(support.index[support >= sampling.MIN_SUPPORT])
+        assert (support < sampling.MIN_SUPPORT).any()
+
+
+def test_extend_keeps_the_sample_of_the_whole(rows):
+    size, head = 2000, 8000
+    sample = sampling.StratifiedSample.draw(rows.iloc[:head], size, seed=0).extend(rows.iloc[head:], size, seed=head)
+
+    keys = np.concatenate([np.random.default_rng(0).random(head), np.random.default_rng(head).random(len(rows) - head)])
+    codes = sampling.strata_codes(rows, [])
+    expected = keys[sampling.smallest(keys, codes, size)]
+    assert np.array_equal(np.sort(sample.rows['Key'].to_numpy()), np.sort(expected))
+    assert sample.population.sum() == len(rows)
+
+
+def test_gunicorn_master_draws_the_sample(tmp_path, monkeypatch):
+    # so that the workers load it instead of all drawing it at once
+    data_file = tmp_path / 'data.csv'
+    shutil.copy(os.environ['DATA_FILE'], data_file)
+    for name, value in [('DATA_MODE', 'aggregates'), ('DATA_FILE', str(data_file)), ('SAMPLE_ROWS', '1000')]:
+        monkeypatch.setenv(name, value)
+    loadtest.gunicorn_config()
+    assert os.path.exists(aggregates.summary_path(str(data_file)))
+    with open(sampling.sample_path(str(data_file)), 'rb') as f:
+        assert pickle.load(f)['size'] == 1000
+    assert sorted(os.listdir(tmp_path)) == ['data.aggregates.pkl', 'data.csv', 'data.sample.pkl']
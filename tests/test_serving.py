@@ -0,0 +1,32 @@
+import os
+
+import pytest
+
+import loadtest
+
+pytest.importorskip('gunicorn')
+pytestmark = pytest.mark.skipif(not os.path.exists('/proc/self/smaps_rollup'), reason='needs Linux /proc')
+
+
+def workers_after_load(preload):
+    """The workers' unique RSS in MiB after a short load test against
+    gunicorn.conf.py with two of them."""
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setenv('GUNICORN_PRELOAD', preload)
+        process, url = loadtest.serve('2x2', 120)
+    try:
+        result = loadtest.load_test(url, [loadtest.SESSION], concurrency=2, duration=3)
+        assert result['requests'] > 0 and not result['errors']
+        return loadtest.workers_unique_rss(process)
+    finally:
+        loadtest.stop(process)
+
+
+def test_preloaded_workers_share_the_app():
+    preloaded = workers_after_load('1')
+    separate = workers_after_load('0')
+    assert len(preloaded) == len(separate) == 2
+    assert all(size > 0 for size in preloaded + separate)
+    # each worker of the second holds a copy of the data and figures that
+    # the first ones share with their master
+    assert sum(preloaded) < 0.6 * sum(separate)
@@ -0,0 +1,61 @@
+import base64
+import json
+
+import numpy as np
+import pytest
+
+HOME_TABS = ['Transactions', 'Sales', 'Profit', 'Quantity', 'Discount']
+PAGE_1_TABS = ['Profit', 'Quantity']
+
+
+def typed_arrays_as_lists(value):
+    # plotly serializes numpy arrays as base64 typed arrays, lists as lists
+    if isinstance(value, dict):
+        if set(value) in ({'dtype', 'bdata'}, {'dtype', 'bdata', 'shape'}):
+            return np.frombuffer(base64.b64decode(value['bdata']), dtype=value['dtype']).tolist()
+        return {k: typed_arrays_as_lists(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [typed_arrays_as_lists(v) for v in value]
+    return value
+
+
+def plain(sidebar, value):
+    """``value``, a figure or store, as the browser receives it."""
+    if hasattr(value, 'to_plotly_json'):
+        value = value.to_plotly_json()
+        value = {'data': value['data'], 'layout': value['layout']}
+    return typed_arrays_as_lists(json.loads(json.dumps(value, cls=sidebar.plotly.utils.PlotlyJSONEncoder)))
+
+
+def client_fill(skeleton, traces, template):
+    # as fill() in assets/clientside.js, which also puts back the template
+    # the store sends once
+    fig = json.loads(json.dumps(skeleton))
+    for trace, arrays in zip(fig['data'], traces):
+        for key, value in arrays.items():
+            trace[key] = dict(trace.get(key, {}), **value) if isinstance(value, dict) else value
+    fig['layout']['template'] = template
+    return fig
+
+
+@pytest.mark.parametrize('option', HOME_TABS)
+def test_home_figures(sidebar, option):
+    store = plain(sidebar, sidebar.home_store())
+    subplot = client_fill(store['subplot'], [{'x': panel['x'], 'y': panel[option]} for panel in store['panels']],
+                          store['template'])
+    assert subplot == plain(sidebar, sidebar.subplot_figure(option))
+
+    metric = 'Sales' if option == 'Transactions' else option
+    states = store['states']
+    bar = client_fill(store['bar'][metric], [{'x': states['x'], 'y': states[metric],
+                                              'marker': {'color': states['Gross PM']}}], store['template'])
+    assert bar == plain(sidebar, sidebar.state_bar_figure(metric))
+
+
+@pytest.mark.parametrize('tab', PAGE_1_TABS)
+def test_discount_figures(sidebar, tab):
+    products = [None] + list(sidebar.discount_tensor['Sub-Category'][0])
+    for product in products:
+        data = sidebar.discount_frame(product)
+        filled = plain(sidebar, sidebar.draw_discount(data, tab, product is None))
+        assert filled == plain(sidebar, sidebar.discount_figure(data, tab, product is None)), product